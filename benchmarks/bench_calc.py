@@ -0,0 +1,141 @@
+"""
+Бенчмарк калькулятора: старый рекурсивный _eval_node (цепочка isinstance + отдельные
+проходы _check_nodes/_find_names) против компиляции в замыкания из configs_folder.calculator.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_calc.py [кол-во_повторов]
+Кэш calc_cache не используется — меряется чистый разбор и вычисление.
+"""
+
+import ast
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from configs_folder.calculator import _SAFE_NAMES, _preprocess, compile_expression
+
+EXPRESSIONS = [
+    "2+2",
+    "sin(pi/4)^2 + cos(pi/4)^2",
+    "sqrt(16) * log(e^3) - floor(7/2) + ceil(1.2)",
+    "((1+2)*(3+4)*(5+6)*(7+8)) // 3 % 1000 + (1 << 10) ^ 255",
+    "factorial(10) / pow(2, 10) + abs(-3.5) + round(2.71828, 3)",
+]
+
+# --- старая реализация (как была в bot.py) ---
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+    ast.LShift, ast.RShift, ast.BitXor, ast.BitAnd, ast.BitOr,
+)
+
+
+def _find_names(node: ast.AST, found: set):
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            found.add(child.id)
+
+
+def _check_nodes(node: ast.AST):
+    for n in ast.walk(node):
+        if not isinstance(n, _ALLOWED_NODES):
+            raise ValueError(f"{type(n).__name__}")
+
+
+def _eval_node(node: ast.AST) -> Any:
+    if isinstance(node, ast.Expression):
+        return _eval_node(node.body)
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.BinOp):
+        left = _eval_node(node.left)
+        right = _eval_node(node.right)
+        op = node.op
+        if isinstance(op, ast.Add):
+            return left + right
+        if isinstance(op, ast.Sub):
+            return left - right
+        if isinstance(op, ast.Mult):
+            return left * right
+        if isinstance(op, ast.Div):
+            return left / right
+        if isinstance(op, ast.FloorDiv):
+            return left // right
+        if isinstance(op, ast.Mod):
+            return left % right
+        if isinstance(op, ast.Pow):
+            return left ** right
+        if isinstance(op, ast.LShift):
+            return left << right
+        if isinstance(op, ast.RShift):
+            return left >> right
+        if isinstance(op, ast.BitXor):
+            return left ^ right
+        if isinstance(op, ast.BitAnd):
+            return left & right
+        if isinstance(op, ast.BitOr):
+            return left | right
+        raise ValueError(f"BinOp {type(op).__name__}")
+    if isinstance(node, ast.UnaryOp):
+        operand = _eval_node(node.operand)
+        if isinstance(node.op, ast.UAdd):
+            return +operand
+        if isinstance(node.op, ast.USub):
+            return -operand
+        raise ValueError(f"UnaryOp {type(node.op).__name__}")
+    if isinstance(node, ast.Name):
+        if node.id in _SAFE_NAMES:
+            return _SAFE_NAMES[node.id]
+        raise NameError(node.id)
+    if isinstance(node, ast.Call):
+        func = node.func
+        if not isinstance(func, ast.Name):
+            raise ValueError("Call must be simple name")
+        if func.id not in _SAFE_NAMES:
+            raise NameError(func.id)
+        fn = _SAFE_NAMES[func.id]
+        args = [_eval_node(a) for a in node.args]
+        return fn(*args)
+    raise ValueError(f"Unsupported node {type(node).__name__}")
+
+
+def _old_full(expr: str) -> Any:
+    node = ast.parse(_preprocess(expr), mode='eval')
+    _check_nodes(node)
+    used = set()
+    _find_names(node, used)
+    if any(name not in _SAFE_NAMES for name in used):
+        raise NameError(used)
+    return _eval_node(node)
+
+
+def _measure(name: str, fn, n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    per_call = (time.perf_counter() - started) / n * 1e6
+    print(f"  {name:<36} {per_call:10.2f} мкс/вызов")
+    return per_call
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"повторов: {n}")
+    for expr in EXPRESSIONS:
+        tree = ast.parse(_preprocess(expr), mode='eval')
+        compiled, _ = compile_expression(expr)
+        assert _eval_node(tree) == compiled(), expr
+
+        print(expr)
+        _measure("старый: parse+check+names+eval", lambda: _old_full(expr), n)
+        _measure("новый:  parse+compile+call", lambda: compile_expression(expr)[0](), n)
+        old = _measure("старый: только _eval_node", lambda: _eval_node(tree), n)
+        new = _measure("новый:  только вызов замыкания", compiled, n)
+        print(f"  вычисление быстрее в {old / new:.1f} раза")
+
+
+if __name__ == "__main__":
+    main()
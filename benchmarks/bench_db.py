@@ -0,0 +1,81 @@
+"""
+Бенчмарк доступа к bot_state.db: задержка одного вызова inc_counter / get_counter_state
+в старом варианте (connect -> запрос -> commit -> close) и через общее соединение db_manager.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_db.py [кол-во_вызовов]
+База создаётся во временной папке, рабочая bot_state.db не трогается.
+"""
+
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from configs_folder.db_manager import Database
+
+
+def _create_counter(path: Path) -> None:
+    conn = sqlite3.connect(str(path))
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS counter_single (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            channel_id INTEGER,
+            next_expected INTEGER NOT NULL
+        );
+    """)
+    conn.execute("INSERT OR IGNORE INTO counter_single (id, channel_id, next_expected) VALUES (1, 1, 1);")
+    conn.commit()
+    conn.close()
+
+
+def _old_inc(path: str) -> None:
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("UPDATE counter_single SET next_expected = next_expected + 1 WHERE id = 1;")
+    conn.commit()
+    conn.close()
+
+
+def _old_get(path: str):
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("SELECT channel_id, next_expected FROM counter_single WHERE id = 1;")
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+
+def _measure(name: str, fn, n: int) -> None:
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    per_call = (time.perf_counter() - started) / n * 1e6
+    print(f"{name:<40} {per_call:10.1f} мкс/вызов")
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path = Path(tmp) / "old.db"
+        new_path = Path(tmp) / "new.db"
+        _create_counter(old_path)
+        _create_counter(new_path)
+
+        database = Database(new_path)
+        database.connection()
+
+        print(f"вызовов: {n}")
+        _measure("старый get_counter_state (connect/close)", lambda: _old_get(str(old_path)), n)
+        _measure("новый  get_counter_state (db_manager)", lambda: database.fetchone(
+            "SELECT channel_id, next_expected FROM counter_single WHERE id = 1;"), n)
+        _measure("старый inc_counter (connect/commit/close)", lambda: _old_inc(str(old_path)), n)
+        _measure("новый  inc_counter (db_manager, WAL)", lambda: database.execute(
+            "UPDATE counter_single SET next_expected = next_expected + 1 WHERE id = 1;"), n)
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
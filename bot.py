@@ -5,7 +5,6 @@ import re
 from pathlib import Path
 import random
 import sys
-import sqlite3
 import json
 import logging
 import socket
@@ -16,14 +15,22 @@ from discord.ext import commands
 from discord.ui import View, Select
 import discord.app_commands
 
-import math
-import ast
+import heapq
+import io
+from collections import deque
+from enum import IntEnum
+import itertools
+import datetime
 
 from playwright.async_api import async_playwright
 
 # Импорт системы управления правами
 sys.path.insert(0, str(Path(__file__).parent / "configs_folder"))
-from configs_folder.perms_manager import PermRole, has_perm, get_user_roles, add_perm, remove_perm, init_perms, can_manage_role, get_hierarchy_level, get_role_description, INDEPENDENT_ROLES
+from configs_folder.db_manager import db, adb
+from configs_folder.calculator import CalcError, calc_evaluate, calc_prepare, calc_cache, format_result, parse_range, calc_range, render_range_plot
+from configs_folder.calc_sandbox import CalcSandbox
+from configs_folder.triggers_manager import triggers, TRIGGERS_FILE
+from configs_folder.perms_manager import PermRole, has_perm, get_user_roles, add_perm, remove_perm, init_perms, can_manage_role, get_hierarchy_level, get_role_description, INDEPENDENT_ROLES, flush_perms
 
 # ------------------ main vars setup ------------------
 SCRIPT_DIR = Path(__file__).parent
@@ -75,6 +82,21 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# ссылки на задачи "выстрелил и забыл", чтобы их не собрал GC
+_spawned_tasks: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    """Запускает корутину отдельной задачей; ошибки пишутся в лог, а не теряются."""
+    task = asyncio.create_task(coro)
+    _spawned_tasks.add(task)
+    task.add_done_callback(_on_spawned_done)
+    return task
+
+def _on_spawned_done(task: asyncio.Task) -> None:
+    _spawned_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Ошибка в фоновой задаче: {task.exception()!r}")
+
 def format_duration(seconds: int) -> str:
     d, seconds = divmod(seconds, 86400)
     h, seconds = divmod(seconds, 3600)
@@ -96,7 +118,9 @@ PELLA_PASSWORD = config_setings["PELLA_PASSWORD"]
 intents = discord.Intents.default()
 intents.members = True          # нужен для работы с Member объектами
 intents.message_content = True  # нужен для префикс-команд (чтение сообщений)
-intents.reactions = True        # нужен для обработки реакций
+# нужен только для role_reaction меню; с кнопочными /role_menu можно выключить ("REACTION_ROLES": false)
+# и не получать событие на каждую реакцию на сервере
+intents.reactions = bool(config_setings.get("REACTION_ROLES", True))
 bot = commands.Bot(command_prefix="?", intents=intents)  # ПРЕФИКС
 GUILD = discord.Object(id=GUILD_ID)
 
@@ -203,93 +227,376 @@ class SoundView(View):
 # ------------------ gemini setup ------------------
 
 
+# ------------------ outbound queue setup ------------------
+# Сообщения и реакции, которые бот отправляет сам (не ответы на interaction), идут через общую очередь:
+# - классы приоритета: уведомление о рестарте не ждёт за мем-ответами;
+# - бакеты по маршрутам (канал, реакции в канале, ЛС) — в пределах лимитов Discord, чтобы не ловить 429;
+#   discord.py не отдаёт заголовки успешных ответов, поэтому лимиты стартуют с документированных
+#   значений и уточняются по X-RateLimit-*/Retry-After из ответов 429, если они до нас доходят;
+# - устаревшие низкоприоритетные отправки выбрасываются, а с одинаковым coalesce_key — схлопываются
+#   (в очереди остаётся только последняя).
+class SendPriority(IntEnum):
+    CRITICAL = 0  # рестарт/выключение
+    HIGH = 1      # личные сообщения о ролях
+    NORMAL = 2    # counting, вход/выход участников
+    LOW = 3       # авто-ответы
+
+# через сколько секунд ожидания отправка уже не нужна (None — отправлять всегда)
+OUTBOUND_STALE_AFTER = {SendPriority.CRITICAL: None, SendPriority.HIGH: 120.0, SendPriority.NORMAL: 60.0, SendPriority.LOW: 10.0}
+# лимиты маршрутов по умолчанию: (запросов, за секунд)
+OUTBOUND_ROUTE_LIMITS = {"channel": (5, 5.0), "reaction": (1, 0.25), "dm": (5, 5.0), "delete": (5, 5.0)}
+OUTBOUND_CONCURRENCY = 4          # одновременных запросов к REST
+OUTBOUND_WAIT_SAMPLES = 256       # по скольким последним отправкам считать время ожидания
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class _OutboundJob:
+    __slots__ = ("priority", "seq", "route", "factory", "future", "enqueued_at", "stale_after", "coalesce_key", "started", "done")
+
+    def __init__(self, priority, seq, route, factory, future, stale_after, coalesce_key):
+        self.priority = priority
+        self.seq = seq
+        self.route = route
+        self.factory = factory
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.stale_after = stale_after
+        self.coalesce_key = coalesce_key
+        self.started = False  # уже вынута из кучи — её не схлопываем, она уходит в Discord
+        self.done = False
+
+    def __lt__(self, other: "_OutboundJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class _RouteBucket:
+    __slots__ = ("capacity", "period", "tokens", "updated", "blocked_until", "jobs", "scheduled", "ready_key")
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.jobs: list[_OutboundJob] = []   # куча отправок этого маршрута
+        self.scheduled: Optional[str] = None  # "ready" — в куче готовых, "sleeping" — ждёт токен, None — пуст
+        self.ready_key: Optional[tuple] = None  # (приоритет, seq) действующей записи в куче готовых
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до следующего свободного запроса (0 — можно сейчас)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.period)
+        self.updated = now
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) * self.period / self.capacity
+
+class _PriorityStats:
+    __slots__ = ("depth", "sent", "failed", "stale", "coalesced", "waits")
+
+    def __init__(self):
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.waits: deque = deque(maxlen=OUTBOUND_WAIT_SAMPLES)
+
+class OutboundQueue:
+    """
+    У каждого маршрута своя куча отправок. Маршруты с токеном лежат в куче готовых
+    (по приоритету своей первой отправки), маршруты без токена — в куче спящих (по времени,
+    когда токен появится). Заблокированный маршрут не перебирается, пока не проснётся.
+    """
+
+    def __init__(self):
+        self._ready: list[tuple[int, int, tuple]] = []     # (приоритет, seq первой отправки, маршрут)
+        self._sleeping: list[tuple[float, int, tuple]] = []  # (когда будет токен, seq, маршрут)
+        self._seq = itertools.count()
+        self._by_key: Dict[Any, _OutboundJob] = {}
+        self._routes: Dict[tuple, _RouteBucket] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[asyncio.Task] = None
+        self.stats = {priority: _PriorityStats() for priority in SendPriority}
+
+    def submit(self, route: tuple, factory, priority: SendPriority = SendPriority.NORMAL,
+               coalesce_key=None, stale_after: Any = "default") -> asyncio.Future:
+        """
+        Поставить отправку в очередь. route — ("channel", id), ("reaction", channel_id) или ("dm", user_id),
+        factory — функция без аргументов, возвращающая корутину запроса.
+        Future получает результат запроса или None (ошибка, устарело, перекрыто).
+        """
+        self._ensure_runner()
+        if stale_after == "default":
+            stale_after = OUTBOUND_STALE_AFTER[priority]
+        future = asyncio.get_running_loop().create_future()
+        job = _OutboundJob(priority, next(self._seq), route, factory, future, stale_after, coalesce_key)
+        if coalesce_key is not None:
+            previous = self._by_key.get(coalesce_key)
+            if previous is not None and not previous.started and not previous.done:
+                self._finish(previous, None)
+                self.stats[previous.priority].coalesced += 1
+            self._by_key[coalesce_key] = job
+        bucket = self._bucket(route)
+        heapq.heappush(bucket.jobs, job)
+        if bucket.scheduled is None:
+            self._schedule(route, bucket, time.monotonic())
+        elif bucket.scheduled == "ready" and bucket.jobs[0] is job:
+            self._push_ready(route, bucket, job)  # новая голова маршрута
+        self.stats[priority].depth += 1
+        self._wakeup.set()
+        return future
+
+    def _ensure_runner(self) -> None:
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(OUTBOUND_CONCURRENCY)
+            self._runner = spawn(self._run())
+
+    def _finish(self, job: _OutboundJob, result) -> None:
+        if job.done:
+            return
+        job.done = True
+        self.stats[job.priority].depth -= 1
+        if job.coalesce_key is not None and self._by_key.get(job.coalesce_key) is job:
+            del self._by_key[job.coalesce_key]
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _bucket(self, route: tuple) -> _RouteBucket:
+        bucket = self._routes.get(route)
+        if bucket is None:
+            bucket = self._routes[route] = _RouteBucket(*OUTBOUND_ROUTE_LIMITS[route[0]])
+        return bucket
+
+    def _head(self, bucket: _RouteBucket, now: float) -> Optional[_OutboundJob]:
+        """Первая живая отправка маршрута; перекрытые и устаревшие выбрасываются."""
+        while bucket.jobs:
+            job = bucket.jobs[0]
+            if job.done:
+                heapq.heappop(bucket.jobs)  # перекрыта более новой
+            elif job.stale_after is not None and now - job.enqueued_at > job.stale_after:
+                heapq.heappop(bucket.jobs)
+                self.stats[job.priority].stale += 1
+                self._finish(job, None)
+            else:
+                return job
+        return None
+
+    def _push_ready(self, route: tuple, bucket: _RouteBucket, head: _OutboundJob) -> None:
+        bucket.ready_key = (head.priority, head.seq)
+        heapq.heappush(self._ready, (head.priority, head.seq, route))
+
+    def _schedule(self, route: tuple, bucket: _RouteBucket, now: float) -> None:
+        """Положить маршрут с отправками в кучу готовых или спящих."""
+        head = self._head(bucket, now)
+        if head is None:
+            bucket.scheduled = None
+            return
+        wait = bucket.wait_time(now)
+        if wait <= 0:
+            bucket.scheduled = "ready"
+            self._push_ready(route, bucket, head)
+        else:
+            bucket.scheduled = "sleeping"
+            heapq.heappush(self._sleeping, (now + wait, next(self._seq), route))
+
+    def _next_ready(self) -> tuple[Optional[_OutboundJob], Optional[float]]:
+        """Самая приоритетная отправка, чей маршрут свободен, или (None, сколько ждать)."""
+        now = time.monotonic()
+        while self._sleeping and self._sleeping[0][0] <= now:
+            route = heapq.heappop(self._sleeping)[2]
+            bucket = self._routes[route]
+            if bucket.scheduled == "sleeping":
+                self._schedule(route, bucket, now)
+
+        while self._ready:
+            priority, seq, route = heapq.heappop(self._ready)
+            bucket = self._routes[route]
+            if bucket.scheduled != "ready" or bucket.ready_key != (priority, seq):
+                continue  # запись устарела — у маршрута есть более свежая
+            head = self._head(bucket, now)
+            if head is None:
+                bucket.scheduled = None
+                continue
+            if (head.priority, head.seq) != (priority, seq):
+                self._push_ready(route, bucket, head)  # голову перекрыли или она устарела
+                continue
+            if bucket.wait_time(now) > 0:
+                self._schedule(route, bucket, now)  # пока ждали, пришёл 429
+                continue
+            heapq.heappop(bucket.jobs)
+            head.started = True
+            bucket.tokens -= 1.0
+            self._schedule(route, bucket, now)
+            return head, None
+
+        return None, (self._sleeping[0][0] - now if self._sleeping else None)
+
+    async def _run(self) -> None:
+        while True:
+            job, delay = self._next_ready()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            spawn(self._execute(job))
+
+    async def _execute(self, job: _OutboundJob) -> None:
+        stats = self.stats[job.priority]
+        stats.waits.append(time.monotonic() - job.enqueued_at)
+        result = None
+        try:
+            result = await job.factory()
+            stats.sent += 1
+        except discord.HTTPException as e:
+            stats.failed += 1
+            if e.status == 429:
+                self._apply_rate_limit(job.route, e)
+            logging.warning(f"Не удалось отправить ({job.route[0]} {job.route[1]}): {e}")
+        except Exception as e:
+            stats.failed += 1
+            logging.warning(f"Не удалось отправить ({job.route[0]} {job.route[1]}): {e}")
+        finally:
+            self._slots.release()
+            self._finish(job, result)
+
+    def _apply_rate_limit(self, route: tuple, error: discord.HTTPException) -> None:
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        bucket = self._bucket(route)
+        retry_after = headers.get("X-RateLimit-Reset-After") or headers.get("Retry-After")
+        limit = headers.get("X-RateLimit-Limit")
+        try:
+            if retry_after is not None:
+                bucket.blocked_until = time.monotonic() + float(retry_after)
+            if limit is not None:
+                bucket.capacity = max(1, int(limit))
+        except ValueError:
+            pass
+        bucket.tokens = 0.0
+
+    def blocked_routes(self) -> int:
+        now = time.monotonic()
+        return sum(1 for bucket in self._routes.values() if bucket.blocked_until > now)
+
+outbound = OutboundQueue()
+
 # ------------------ BD setup ------------------
 
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "bot_state.db")  # файл базы рядом со скриптом
+# одно общее соединение с bot_state.db (WAL), см. configs_folder/db_manager.py
+# db — синхронно (только при импорте), adb — из корутин, запросы выполняются в отдельном потоке
+DB_PATH = str(db.path)  # файл базы рядом со скриптом
 
 # --- Инициализация БД (выполняется при импорте модуля) ---
-def _init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS restart_state (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            channel_id INTEGER
-        );
-    """)
-    # гарантируем одну строку с id=1
-    cur.execute("INSERT OR IGNORE INTO restart_state (id, channel_id) VALUES (1, NULL);")
-    
-    # Таблица для join_leave
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS join_leave (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            channel_id INTEGER
-        );
-    """)
-    # гарантируем одну строку с id=1
-    cur.execute("INSERT OR IGNORE INTO join_leave (id, channel_id) VALUES (1, NULL);")
-    
-    # Таблица для role_reaction (реакции с автоматической выдачей ролей)
+def _migrate_role_reactions_unique(cur) -> None:
+    """Старая схема role_reactions: message_id UNIQUE (одна роль на сообщение) -> UNIQUE (message_id, emoji)."""
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'role_reactions';")
+    row = cur.fetchone()
+    if not row or "message_id INTEGER UNIQUE" not in row[0]:
+        return
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS role_reactions (
+        CREATE TABLE role_reactions_new (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message_id INTEGER UNIQUE NOT NULL,
+            message_id INTEGER NOT NULL,
             channel_id INTEGER NOT NULL,
             emoji TEXT NOT NULL,
-            role_id INTEGER NOT NULL
+            role_id INTEGER NOT NULL,
+            UNIQUE (message_id, emoji)
         );
     """)
-    conn.commit()
-    conn.close()
+    cur.execute("""
+        INSERT INTO role_reactions_new (id, message_id, channel_id, emoji, role_id)
+        SELECT id, message_id, channel_id, emoji, role_id FROM role_reactions;
+    """)
+    cur.execute("DROP TABLE role_reactions;")
+    cur.execute("ALTER TABLE role_reactions_new RENAME TO role_reactions;")
+    logging.info("role_reactions: схема обновлена для меню с несколькими ролями")
+
+def _init_db():
+    with db.transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS restart_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                channel_id INTEGER
+            );
+        """)
+        # гарантируем одну строку с id=1
+        cur.execute("INSERT OR IGNORE INTO restart_state (id, channel_id) VALUES (1, NULL);")
+    
+        # Таблица для join_leave
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS join_leave (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                channel_id INTEGER
+            );
+        """)
+        # гарантируем одну строку с id=1
+        cur.execute("INSERT OR IGNORE INTO join_leave (id, channel_id) VALUES (1, NULL);")
+    
+        # Таблица для role_reaction (реакции с автоматической выдачей ролей)
+        # на одном сообщении может быть много пар эмодзи -> роль (меню ролей)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS role_reactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                emoji TEXT NOT NULL,
+                role_id INTEGER NOT NULL,
+                UNIQUE (message_id, emoji)
+            );
+        """)
+        _migrate_role_reactions_unique(cur)
+
+        # Пользователи, отказавшиеся от ЛС о выдаче/снятии ролей
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS dm_optout (
+                user_id INTEGER PRIMARY KEY
+            );
+        """)
 
 _init_db()
 
 # --- Функции работы с каналом join_leave ---
-def save_join_leave_channel(channel_id: Optional[int]) -> None:
+# канал уведомлений держим в памяти: при рейде не нужен запрос к БД на каждого участника
+_join_leave_channel: Optional[int] = (db.fetchone("SELECT channel_id FROM join_leave WHERE id = 1;") or (None,))[0]
+
+async def save_join_leave_channel(channel_id: Optional[int]) -> None:
     """Сохраняет ID канала, куда надо отправить уведомление при выходе/входе участников на сервер."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE join_leave SET channel_id = ? WHERE id = 1;", (channel_id,))
-    conn.commit()
-    conn.close()
+    global _join_leave_channel
+    await adb.execute("UPDATE join_leave SET channel_id = ? WHERE id = 1;", (channel_id,))
+    _join_leave_channel = channel_id
 
 def get_join_leave_channel() -> Optional[int]:
     """Возвращает сохранённый channel_id для join/leave."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT channel_id FROM join_leave WHERE id = 1;")
-    row = cur.fetchone()
-    channel_id = row[0] if row else None
-    conn.close()
-    return channel_id
+    return _join_leave_channel
 
 # --- Функции работы с состоянием рестарта ---
-def save_restart_channel(channel_id: Optional[int]) -> None:
+async def save_restart_channel(channel_id: Optional[int]) -> None:
     """Сохраняет ID канала, куда надо отправить уведомление после рестарта."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE restart_state SET channel_id = ? WHERE id = 1;", (channel_id,))
-    conn.commit()
-    conn.close()
+    await adb.execute("UPDATE restart_state SET channel_id = ? WHERE id = 1;", (channel_id,))
 
-def pop_restart_channel() -> Optional[int]:
+async def pop_restart_channel() -> Optional[int]:
     """Возвращает сохранённый channel_id и очищает поле в БД."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT channel_id FROM restart_state WHERE id = 1;")
-    row = cur.fetchone()
-    channel_id = row[0] if row else None
-    # очищаем
-    cur.execute("UPDATE restart_state SET channel_id = NULL WHERE id = 1;")
-    conn.commit()
-    conn.close()
-    return channel_id
+    def _pop(cur):
+        cur.execute("SELECT channel_id FROM restart_state WHERE id = 1;")
+        row = cur.fetchone()
+        # очищаем
+        cur.execute("UPDATE restart_state SET channel_id = NULL WHERE id = 1;")
+        return row[0] if row else None
+
+    return await adb.run(_pop)
 
 async def notify_after_restart():
     # вызывается из on_ready после того как бот залогинился
-    channel_id = pop_restart_channel()
+    channel_id = await pop_restart_channel()
     if not channel_id:
         return  # ничего не нужно делать
 
@@ -310,260 +617,1304 @@ async def notify_after_restart():
         if not perms.send_messages:
             # если нельзя писать в канале — попытка DM владельцу
             owner = bot.get_user(OWNER_ID) or await bot.fetch_user(OWNER_ID)
-            try:
-                await owner.send(f"⚠ Не удалось отправить уведомление о рестарте в канал {channel_id} — нет прав.")
-            except Exception:
-                pass
+            await outbound.submit(("dm", OWNER_ID), lambda: owner.send(
+                f"⚠ Не удалось отправить уведомление о рестарте в канал {channel_id} — нет прав."), SendPriority.CRITICAL)
             return
 
-        await ch.send("✅ Бот успешно перезапущен.")
+        await outbound.submit(("channel", ch.id), lambda: ch.send("✅ Бот успешно перезапущен."), SendPriority.CRITICAL)
     except Exception as e:
         logging.warning(f"Ошибка при отправке уведомления о рестарте: {e}")
 
 # --- Функции работы с role_reactions ---
-def save_role_reaction(message_id: int, channel_id: int, emoji: str, role_id: int) -> None:
-    """Сохраняет информацию о role_reaction в БД."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
+# У одного сообщения может быть много пар эмодзи -> роль.
+# Индекс в памяти: (message_id, emoji) -> (message_id, channel_id, emoji, role_id)
+# и множество отслеживаемых сообщений. Загружается при старте и меняется вместе с БД,
+# так что реакции/удаления на обычных сообщениях отбрасываются без обращения к базе.
+_role_reactions: Dict[tuple[int, str], tuple] = {}
+_role_reaction_messages: set[int] = set()
+
+def _index_role_reaction(row: tuple) -> None:
+    message_id, channel_id, emoji, role_id = row
+    _role_reactions[(int(message_id), emoji)] = (int(message_id), int(channel_id), emoji, int(role_id))
+    _role_reaction_messages.add(int(message_id))
+
+def _unindex_role_reactions(message_id: int) -> None:
+    _role_reaction_messages.discard(message_id)
+    for key in [k for k in _role_reactions if k[0] == message_id]:
+        del _role_reactions[key]
+
+def _load_role_reactions() -> None:
+    """Загружает все role_reactions из БД в индекс (выполняется при импорте модуля)."""
+    _role_reactions.clear()
+    _role_reaction_messages.clear()
+    for row in db.fetchall("SELECT message_id, channel_id, emoji, role_id FROM role_reactions;"):
+        _index_role_reaction(row)
+
+_load_role_reactions()
+
+def is_role_reaction_message(message_id: int) -> bool:
+    """Есть ли у сообщения role_reaction (без обращения к БД)."""
+    return message_id in _role_reaction_messages
+
+async def save_role_reaction(message_id: int, channel_id: int, emoji: str, role_id: int) -> None:
+    """Сохраняет информацию о role_reaction в БД (пара эмодзи -> роль на сообщении)."""
+    await save_role_reactions([(message_id, channel_id, emoji, role_id)])
+
+async def save_role_reactions(rows: list[tuple[int, int, str, int]]) -> None:
+    """Сохраняет сразу несколько пар (message_id, channel_id, emoji, role_id) одной транзакцией."""
+    await adb.executemany("""
         INSERT OR REPLACE INTO role_reactions (message_id, channel_id, emoji, role_id)
         VALUES (?, ?, ?, ?)
-    """, (message_id, channel_id, emoji, role_id))
-    conn.commit()
-    conn.close()
+    """, rows)
+    for row in rows:
+        _index_role_reaction(row)
 
 def get_role_reaction(message_id: int, emoji: str) -> Optional[tuple]:
     """Получает информацию о role_reaction: (message_id, channel_id, emoji, role_id)."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT message_id, channel_id, emoji, role_id FROM role_reactions
-        WHERE message_id = ? AND emoji = ?
-    """, (message_id, emoji))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return _role_reactions.get((message_id, emoji))
 
 def get_all_role_reactions_for_message(message_id: int) -> list:
     """Получает все role_reactions для сообщения."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT message_id, channel_id, emoji, role_id FROM role_reactions
-        WHERE message_id = ?
-    """, (message_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    if message_id not in _role_reaction_messages:
+        return []
+    return [row for key, row in _role_reactions.items() if key[0] == message_id]
 
-def delete_role_reaction(message_id: int) -> None:
+async def delete_role_reaction(message_id: int) -> None:
     """Удаляет role_reaction из БД по ID сообщения."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
+    if message_id not in _role_reaction_messages:
+        return
+    await adb.execute("""
         DELETE FROM role_reactions WHERE message_id = ?
     """, (message_id,))
-    conn.commit()
-    conn.close()
+    _unindex_role_reactions(message_id)
 
-# ------------------ calculate setup ------------------
+# ------------------ role edit queue setup ------------------
+ROLE_BATCH_WINDOW = 1.5        # сек: изменения ролей одного участника за это время склеиваются в один запрос
+ROLE_EDIT_MIN_INTERVAL = 0.25  # сек: пауза между запросами изменения ролей в одной гильдии
 
+class RoleEditQueue:
+    """
+    Очередь изменений ролей одной гильдии.
+    Реакции участника за ROLE_BATCH_WINDOW схлопываются до итоговой разницы и применяются одним
+    member.edit(roles=...). Итоговый набор считается от ролей участника в кэше (его обновляет gateway)
+    в момент отправки, так что изменения модераторов и других ботов до этого момента сохраняются.
+    Запросы гильдии идут строго по одному (discord.py ждёт сброса bucket'а по заголовкам
+    rate limit), так что сотни кликов по популярному меню не превращаются в сотни 429.
+    """
 
-_PREPROCESS_REPLACES = {
-    '^': '**',
-    'tg(': 'tan(',
-    'ctg(': '1/tan(',
-    'ln(': 'log('
-}
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        # member_id -> role_id -> (выдать?, future). Поздний запрос по той же роли перекрывает ранний.
+        self._pending: Dict[int, Dict[int, tuple[bool, asyncio.Future]]] = {}
+        self._members: Dict[int, discord.Member] = {}
+        self._reasons: Dict[int, str] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def submit(self, member: discord.Member, role: discord.Role, add: bool, reason: str = "") -> asyncio.Future:
+        """
+        Ставит выдачу (add=True) или снятие роли в очередь.
+        Future вернёт, была ли роль у участника до изменения, или None, если запрос перекрыт более поздним.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        changes = self._pending.get(member.id)
+        if changes is None:
+            changes = self._pending[member.id] = {}
+            loop.call_later(ROLE_BATCH_WINDOW, self._ready.put_nowait, member.id)
+        previous = changes.get(role.id)
+        if previous is not None and not previous[1].done():
+            previous[1].set_result(None)
+        changes[role.id] = (add, fut)
+        self._members[member.id] = member
+        self._reasons[member.id] = reason
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return fut
+
+    async def _run(self):
+        while True:
+            member_id = await self._ready.get()
+            changes = self._pending.pop(member_id, {})
+            member = self._members.pop(member_id, None)
+            reason = self._reasons.pop(member_id, None)
+            if not changes or member is None:
+                continue
+            try:
+                await self._apply(member, changes, reason)
+            except Exception as e:
+                logging.error(f"Ошибка при изменении ролей {member_id}: {e}")
+                for _, fut in changes.values():
+                    if not fut.done():
+                        fut.set_exception(e)
+            await asyncio.sleep(ROLE_EDIT_MIN_INTERVAL)
+
+    async def _apply(self, member: discord.Member, changes: Dict[int, tuple[bool, asyncio.Future]], reason: Optional[str]):
+        guild = member.guild
+        # берём актуальный объект участника из кэша, за окно его роли могли поменяться
+        member = guild.get_member(member.id) or member
+        before = {r.id for r in member.roles if r.id != guild.id}
+        after = set(before)
+        for role_id, (add, _) in changes.items():
+            if add and guild.get_role(role_id) is not None:
+                after.add(role_id)
+            elif not add:
+                after.discard(role_id)
+
+        if after != before:
+            # один запрос на всю пачку; add_roles/remove_roles слали бы по запросу на каждую роль
+            await self._with_retry(lambda: member.edit(
+                roles=[r for r in (guild.get_role(role_id) for role_id in after) if r is not None],
+                reason=reason or None,
+            ))
+
+        for role_id, (_, fut) in changes.items():
+            if not fut.done():
+                fut.set_result(role_id in before)
+
+    @staticmethod
+    async def _with_retry(request) -> None:
+        while True:
+            try:
+                await request()
+                return
+            except discord.HTTPException as e:
+                if getattr(e, "status", None) != 429:
+                    raise
+                # discord.py обычно ждёт сам, это страховка на случай глобального лимита
+                await asyncio.sleep(float(getattr(e, "retry_after", 1.0) or 1.0))
+
+_role_queues: Dict[int, RoleEditQueue] = {}
+
+# пара "эмодзи @роль" в аргументе /role_reaction_menu и /role_menu
+ROLE_MENU_PAIR_RE = re.compile(r"(\S+)\s*<@&(\d+)>")
+ROLE_MENU_MAX_PAIRS = 20  # лимит реакций на сообщении в Discord
+ROLE_MENU_MAX_BUTTONS = 25  # 5 рядов по 5 кнопок
+
+def parse_role_menu(guild: discord.Guild, bot_member: discord.Member, pairs: str) -> tuple[list, Optional[str]]:
+    """Разбирает "🎮 @Игрок; 🎨 @Художник" в [(эмодзи, роль)]. Возвращает (меню, текст_ошибки)."""
+    menu = []
+    for emoji, role_id in ROLE_MENU_PAIR_RE.findall(pairs):
+        emoji = emoji.strip(";,")
+        role = guild.get_role(int(role_id))
+        if role is None:
+            return [], f"❌ Роль `{role_id}` не найдена."
+        if role.position >= bot_member.top_role.position:
+            return [], f"❌ Не могу управлять ролью {role.mention}. Роль выше или равна роли бота."
+        menu.append((emoji, role))
+    if not menu:
+        return [], "❌ Не найдено ни одной пары `эмодзи @роль`."
+    return menu, None
 
-_SAFE_NAMES = {
-    'pi': math.pi,
-    'e': math.e,
-    'sin': math.sin,
-    'cos': math.cos,
-    'tan': math.tan,
-    'asin': math.asin,
-    'acos': math.acos,
-    'atan': math.atan,
-    'sinh': math.sinh,
-    'cosh': math.cosh,
-    'tanh': math.tanh,
-    'sqrt': math.sqrt,
-    'log': math.log,
-    'log10': math.log10,
-    'log2': math.log2,
-    'abs': abs,
-    'floor': math.floor,
-    'ceil': math.ceil,
-    'round': round,
-    'factorial': math.factorial,
-    'pow': pow,
-}
+class RoleMenuButton(discord.ui.DynamicItem[discord.ui.Button], template=r"role_menu:(?P<role_id>[0-9]+)"):
+    """
+    Кнопка меню ролей (/role_menu): нажатие выдаёт или снимает роль.
+    ID роли зашит в custom_id, поэтому кнопки всех меню обслуживаются одной
+    регистрацией при старте (bot.add_dynamic_items) и переживают рестарт без БД.
+    """
+
+    def __init__(self, role_id: int, label: Optional[str] = None, emoji: Optional[str] = None):
+        super().__init__(
+            discord.ui.Button(
+                label=label,
+                emoji=emoji or None,
+                style=discord.ButtonStyle.secondary,
+                custom_id=f"role_menu:{role_id}",
+            )
+        )
+        self.role_id = role_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match):
+        return cls(int(match["role_id"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        guild = interaction.guild
+        if guild is None:
+            await interaction.response.send_message("Меню работает только на сервере.", ephemeral=True)
+            return
+        role = guild.get_role(self.role_id)
+        if role is None:
+            await interaction.response.send_message("❌ Роль больше не существует.", ephemeral=True)
+            return
+
+        # окно склейки очереди длиннее 3 секунд ответа — сначала defer
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        member = interaction.user
+        add = role not in member.roles
+        try:
+            had_role = await get_role_queue(guild.id).submit(member, role, add=add, reason="Role menu")
+        except discord.Forbidden:
+            await interaction.followup.send("❌ У бота недостаточно прав для этой роли.", ephemeral=True)
+            return
+        except Exception as e:
+            logging.error(f"Ошибка при изменении роли из меню: {e}")
+            await interaction.followup.send("❌ Не удалось изменить роль.", ephemeral=True)
+            return
+
+        if had_role is None:
+            await interaction.followup.send("ℹ️ Запрос перекрыт следующим нажатием.", ephemeral=True)
+        elif add:
+            await interaction.followup.send(f"✅ Вам выдана роль **{role.name}**", ephemeral=True)
+        else:
+            await interaction.followup.send(f"✅ С вас снята роль **{role.name}**", ephemeral=True)
+
+def build_role_menu_view(menu: list) -> discord.ui.View:
+    """View с кнопками для [(эмодзи, роль)]. timeout=None — кнопки не истекают."""
+    view = discord.ui.View(timeout=None)
+    for emoji, role in menu:
+        view.add_item(RoleMenuButton(role.id, label=role.name, emoji=emoji))
+    return view
+
+def get_role_queue(guild_id: int) -> RoleEditQueue:
+    """Очередь изменений ролей для гильдии (создаётся при первом обращении)."""
+    queue = _role_queues.get(guild_id)
+    if queue is None:
+        queue = _role_queues[guild_id] = RoleEditQueue(guild_id)
+    return queue
+
+# ------------------ role DM notifications setup ------------------
+ROLE_DM_WINDOW = 5.0            # сек: изменения ролей участника за это время уходят одним ЛС
+ROLE_DM_USER_MAX = 3            # не больше ЛС одному участнику...
+ROLE_DM_USER_PERIOD = 600.0     # ...за столько секунд
+ROLE_DM_GLOBAL_MAX = 20         # не больше ЛС всем вместе...
+ROLE_DM_GLOBAL_PERIOD = 60.0    # ...за столько секунд
+
+# участники, отключившие ЛС о ролях (/role_dm), загружаются при старте
+_dm_optout: set[int] = {row[0] for row in db.fetchall("SELECT user_id FROM dm_optout;")}
+
+async def set_role_dm_enabled(user_id: int, enabled: bool) -> None:
+    """Включает/выключает ЛС о ролях для участника."""
+    if enabled:
+        await adb.execute("DELETE FROM dm_optout WHERE user_id = ?;", (user_id,))
+        _dm_optout.discard(user_id)
+    else:
+        await adb.execute("INSERT OR IGNORE INTO dm_optout (user_id) VALUES (?);", (user_id,))
+        _dm_optout.add(user_id)
+
+class RoleNotifier:
+    """
+    ЛС участникам об изменении их ролей.
+    - о том, что ничего не изменилось ("роль уже была"), не пишем вовсе;
+    - изменения за ROLE_DM_WINDOW собираются в одно сообщение, выдача+снятие одной роли взаимно гасятся;
+    - есть лимиты на участника и общий, чтобы ЛС не съедали общий rate limit бота;
+    - участник может отказаться от ЛС (/role_dm).
+    """
 
-_ALLOWED_NODES = (
-    ast.Expression,
-    ast.BinOp,
-    ast.UnaryOp,
-    ast.Call,
-    ast.Name,
-    ast.Load,
-    ast.Constant,
-    ast.Add,
-    ast.Sub,
-    ast.Mult,
-    ast.Div,
-    ast.FloorDiv,
-    ast.Mod,
-    ast.Pow,
-    ast.USub,
-    ast.UAdd,
-    ast.LShift,
-    ast.RShift,
-    ast.BitXor,
-    ast.BitAnd,
-    ast.BitOr,
+    def __init__(self):
+        # user_id -> role_id -> [было_до, стало, название роли]
+        self._pending: Dict[int, Dict[int, list]] = {}
+        self._members: Dict[int, discord.Member] = {}
+        self._user_sent: Dict[int, list[float]] = {}
+        self._global_sent: list[float] = []
+        self._swept_at = time.monotonic()
+        self.dropped = 0
+
+    def notify(self, member: discord.Member, role: discord.Role, granted: bool) -> None:
+        """Сообщить, что роль участнику реально выдана (granted=True) или снята."""
+        if member.id in _dm_optout:
+            return
+        changes = self._pending.get(member.id)
+        if changes is None:
+            changes = self._pending[member.id] = {}
+            asyncio.get_running_loop().call_later(ROLE_DM_WINDOW, lambda: spawn(self._flush(member.id)))
+        state = changes.get(role.id)
+        if state is None:
+            changes[role.id] = [not granted, granted, role.name]
+        else:
+            state[1] = granted
+            state[2] = role.name
+        self._members[member.id] = member
+
+    @staticmethod
+    def _within_budget(sent: list[float], limit: int, period: float, now: float) -> bool:
+        while sent and now - sent[0] > period:
+            sent.pop(0)
+        return len(sent) < limit
+
+    def _sweep(self, now: float) -> None:
+        """Раз в ROLE_DM_USER_PERIOD выкинуть участников, чьи ЛС уже вне окна лимита."""
+        if now - self._swept_at < ROLE_DM_USER_PERIOD:
+            return
+        self._swept_at = now
+        for user_id in [uid for uid, sent in self._user_sent.items() if not sent or now - sent[-1] > ROLE_DM_USER_PERIOD]:
+            del self._user_sent[user_id]
+
+    async def _flush(self, user_id: int) -> None:
+        changes = self._pending.pop(user_id, {})
+        member = self._members.pop(user_id, None)
+        if member is None or user_id in _dm_optout:
+            return
+
+        granted = [name for before, after, name in changes.values() if after and not before]
+        removed = [name for before, after, name in changes.values() if before and not after]
+        if not granted and not removed:
+            return  # за окно всё вернулось как было
+
+        now = time.monotonic()
+        self._sweep(now)
+        user_sent = self._user_sent.setdefault(user_id, [])
+        if not self._within_budget(user_sent, ROLE_DM_USER_MAX, ROLE_DM_USER_PERIOD, now) \
+                or not self._within_budget(self._global_sent, ROLE_DM_GLOBAL_MAX, ROLE_DM_GLOBAL_PERIOD, now):
+            self.dropped += 1
+            return
+        user_sent.append(now)
+        self._global_sent.append(now)
+
+        lines = []
+        if granted:
+            lines.append("✅ Вам выданы роли: " + ", ".join(f"**{name}**" for name in granted))
+        if removed:
+            lines.append("➖ С вас сняты роли: " + ", ".join(f"**{name}**" for name in removed))
+        lines.append("-# Отключить эти сообщения: /role_dm enabled:False")
+        text = "\n".join(lines)
+        outbound.submit(("dm", user_id), lambda: member.send(text), SendPriority.HIGH)
+
+role_notifier = RoleNotifier()
+
+# ------------------ join/leave announcements setup ------------------
+JOIN_LEAVE_WINDOW = 10.0          # сек: скользящее окно, по которому считается частота входов/выходов
+JOIN_LEAVE_RAID_THRESHOLD = 5     # столько событий за окно — дальше вместо сообщений на каждого идёт сводка
+JOIN_LEAVE_SUMMARY_DELAY = 5.0    # сек: как часто во время рейда отправлять сводку
+JOIN_LEAVE_SUMMARY_NAMES = 30     # сколько участников перечислить в сводке по именам
+
+# корзины гистограммы возраста аккаунтов: (верхняя граница в секундах, подпись)
+ACCOUNT_AGE_BUCKETS = (
+    (3600, "< 1 ч"),
+    (86400, "< 1 д"),
+    (7 * 86400, "< 7 д"),
+    (30 * 86400, "< 30 д"),
+    (365 * 86400, "< 1 г"),
+    (None, ">= 1 г"),
 )
 
-def _preprocess(expr: str) -> str:
-    s = expr
-    for k, v in _PREPROCESS_REPLACES.items():
-        s = s.replace(k, v)
-    return s
-
-def _find_names(node: ast.AST, found: set):
-    for child in ast.walk(node):
-        if isinstance(child, ast.Name):
-            found.add(child.id)
-
-def _check_nodes(node: ast.AST):
-    for n in ast.walk(node):
-        if not isinstance(n, _ALLOWED_NODES):
-            raise ValueError(f"{type(n).__name__}")
-
-def _eval_node(node: ast.AST) -> Any:
-    if isinstance(node, ast.Expression):
-        return _eval_node(node.body)
-
-    if isinstance(node, ast.Constant):
-        return node.value
-
-    if isinstance(node, ast.BinOp):
-        left = _eval_node(node.left)
-        right = _eval_node(node.right)
-        op = node.op
-        if isinstance(op, ast.Add):
-            return left + right
-        if isinstance(op, ast.Sub):
-            return left - right
-        if isinstance(op, ast.Mult):
-            return left * right
-        if isinstance(op, ast.Div):
-            return left / right
-        if isinstance(op, ast.FloorDiv):
-            return left // right
-        if isinstance(op, ast.Mod):
-            return left % right
-        if isinstance(op, ast.Pow):
-            return left ** right
-        if isinstance(op, ast.LShift):
-            return left << right
-        if isinstance(op, ast.RShift):
-            return left >> right
-        if isinstance(op, ast.BitXor):
-            return left ^ right
-        if isinstance(op, ast.BitAnd):
-            return left & right
-        if isinstance(op, ast.BitOr):
-            return left | right
-        raise ValueError(f"BinOp {type(op).__name__}")
-
-    if isinstance(node, ast.UnaryOp):
-        operand = _eval_node(node.operand)
-        if isinstance(node.op, ast.UAdd):
-            return +operand
-        if isinstance(node.op, ast.USub):
-            return -operand
-        raise ValueError(f"UnaryOp {type(node.op).__name__}")
-
-    if isinstance(node, ast.Name):
-        if node.id in _SAFE_NAMES:
-            return _SAFE_NAMES[node.id]
-        raise NameError(node.id)
-
-    if isinstance(node, ast.Call):
-        func = node.func
-        if not isinstance(func, ast.Name):
-            raise ValueError("Call must be simple name")
-        func_name = func.id
-        if func_name not in _SAFE_NAMES:
-            raise NameError(func_name)
-        fn = _SAFE_NAMES[func_name]
-        args = [_eval_node(a) for a in node.args]
-        return fn(*args)
-
-    raise ValueError(f"Unsupported node {type(node).__name__}")
+def _account_age_bucket(member: discord.Member, now: datetime.datetime) -> int:
+    age = (now - member.created_at).total_seconds()
+    for i, (limit, _) in enumerate(ACCOUNT_AGE_BUCKETS):
+        if limit is None or age < limit:
+            return i
+    return len(ACCOUNT_AGE_BUCKETS) - 1
+
+class _AnnounceStream:
+    """Входы или выходы: окно последних событий и накопленная во время рейда сводка."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.recent: deque = deque()
+        self.raid = False
+        self.batch: list[tuple[str, int]] = []       # (имя, id) участников текущей сводки
+        self.ages = [0] * len(ACCOUNT_AGE_BUCKETS)   # гистограмма возраста аккаунтов текущей сводки
+        self.batch_started = 0.0
+
+    def rate(self, now: float) -> int:
+        while self.recent and now - self.recent[0] > JOIN_LEAVE_WINDOW:
+            self.recent.popleft()
+        return len(self.recent)
+
+class JoinLeaveAnnouncer:
+    """
+    Уведомления о входе/выходе участников в канал join_leave.
+    В обычном режиме — одно сообщение на участника. Если за JOIN_LEAVE_WINDOW событий набралось
+    JOIN_LEAVE_RAID_THRESHOLD, поток переходит в режим рейда: участники копятся и раз в
+    JOIN_LEAVE_SUMMARY_DELAY уходят одной сводкой с гистограммой возраста аккаунтов.
+    Режим рейда заканчивается, когда частота падает ниже порога.
+    """
+
+    def __init__(self):
+        self.streams = {"join": _AnnounceStream("join"), "leave": _AnnounceStream("leave")}
+
+    def announce(self, kind: str, member: discord.Member) -> None:
+        channel_id = get_join_leave_channel()
+        if channel_id is None:
+            return
+        stream = self.streams[kind]
+        now = time.monotonic()
+        stream.recent.append(now)
+        if not stream.raid and stream.rate(now) < JOIN_LEAVE_RAID_THRESHOLD:
+            self._send(channel_id, self._single_text(kind, member))
+            return
+
+        if not stream.raid:
+            stream.raid = True
+            stream.batch_started = now
+            asyncio.get_running_loop().call_later(JOIN_LEAVE_SUMMARY_DELAY, self._flush, stream)
+        stream.batch.append((member.name, member.id))
+        stream.ages[_account_age_bucket(member, discord.utils.utcnow())] += 1
+
+    @staticmethod
+    def _single_text(kind: str, member: discord.Member) -> str:
+        if kind == "join":
+            return f"Добро пожаловать, {member.mention}! ({member.name}, id: `{member.id}` )"
+        return f"Пользователь {member.mention} ({member.name}) id: `{member.id}` покинул сервер."
+
+    @staticmethod
+    def _send(channel_id: int, text: str) -> None:
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            return
+        outbound.submit(("channel", channel_id), lambda: channel.send(text), SendPriority.NORMAL)
+
+    def _flush(self, stream: _AnnounceStream) -> None:
+        now = time.monotonic()
+        batch, ages = stream.batch, stream.ages
+        elapsed = now - stream.batch_started
+        stream.batch, stream.ages = [], [0] * len(ACCOUNT_AGE_BUCKETS)
+        if stream.rate(now) >= JOIN_LEAVE_RAID_THRESHOLD:
+            stream.batch_started = now
+            asyncio.get_running_loop().call_later(JOIN_LEAVE_SUMMARY_DELAY, self._flush, stream)
+        else:
+            stream.raid = False
+
+        channel_id = get_join_leave_channel()
+        if not batch or channel_id is None:
+            return
+        self._send(channel_id, self._summary_text(stream.kind, batch, ages, elapsed))
+
+    @staticmethod
+    def _summary_text(kind: str, batch: list[tuple[str, int]], ages: list[int], elapsed: float) -> str:
+        title = "Массовый вход" if kind == "join" else "Массовый выход"
+        peak = max(ages)
+        lines = [f"🚨 {title}: **{len(batch)}** участников за {elapsed:.0f} с.", "Возраст аккаунтов:", "```"]
+        for (_, label), count in zip(ACCOUNT_AGE_BUCKETS, ages):
+            bar = "█" * round(20 * count / peak) if peak else ""
+            lines.append(f"{label:<7}{count:>6} {bar}")
+        lines.append("```")
+        names = ", ".join(f"{name} (`{member_id}`)" for name, member_id in batch[:JOIN_LEAVE_SUMMARY_NAMES])
+        if len(batch) > JOIN_LEAVE_SUMMARY_NAMES:
+            names += f" … и ещё {len(batch) - JOIN_LEAVE_SUMMARY_NAMES}"
+        lines.append(names)
+        return "\n".join(lines)[:2000]
+
+join_leave_announcer = JoinLeaveAnnouncer()
+
+# ------------------ calculate setup ------------------
+CALC_MAX_MESSAGE_CHARS = 1800  # результат длиннее отправляется файлом
+CALC_RANGE_TABLE_ROWS = 15     # сколько строк таблицы диапазона показывать в сообщении (полная — в CSV)
+
+def _format_range_reply(expression: str, result) -> str:
+    stats = result.stats()
+    var = result.var
+    mode = "numpy" if result.vectorized else "поточечно"
+    lines = [f"`{expression}` — {stats['count']} точек ({mode})"]
+    if "min" in stats:
+        (min_x, min_y), (max_x, max_y) = stats["min"], stats["max"]
+        lines.append(
+            f"мин: **{min_y:.6g}** при {var} = {min_x:.6g}; макс: **{max_y:.6g}** при {var} = {max_x:.6g}; "
+            f"среднее: **{stats['mean']:.6g}**"
+        )
+    if stats["errors"]:
+        lines.append(f"не определено в {stats['errors']} точках")
+    stride = result.csv_stride()
+    if stride > 1:
+        lines.append(f"в CSV — каждая {stride}-я точка")
+
+    n = len(result.xs)
+    rows = CALC_RANGE_TABLE_ROWS if n > CALC_RANGE_TABLE_ROWS else n
+    indices = sorted({round(i * (n - 1) / (rows - 1)) for i in range(rows)}) if rows > 1 else [0]
+    table = [f"{var:>12}  значение"]
+    table.extend(f"{result.xs[i]:>12.6g}  {result.ys[i]:.10g}" for i in indices)
+    lines.append("```\n" + "\n".join(table) + "\n```")
+    return "\n".join(lines)
+
+calc_sandbox = CalcSandbox()
+
+# ------------------ reply rate limit setup ------------------
+# Ответы бота в чат (авто-ответы, предупреждения counting, подсказка про гифки) проходят через
+# токен-бакеты: отдельно на пользователя, на канал и на триггер. Во время рейда со спамом
+# @everyone бот отвечает несколько раз и замолкает, а не тратит весь REST-лимит на ответы.
+# Бюджеты — "REPLY_LIMITS" в setings.json: {"user": [ответов, за секунд], "channel": [...], "trigger": [...]}
+REPLY_LIMITS_DEFAULT = {"user": (3, 30.0), "channel": (6, 15.0), "trigger": (20, 60.0)}
+REPLY_LIMITER_SWEEP_EVERY = 1024  # раз в сколько проверок выкидывать наполнившиеся бакеты
+
+def _load_reply_limits() -> Dict[str, tuple[float, float]]:
+    budgets = dict(REPLY_LIMITS_DEFAULT)
+    for scope, value in (config_setings.get("REPLY_LIMITS") or {}).items():
+        if scope in budgets:
+            capacity, period = value
+            budgets[scope] = (float(capacity), float(period))
+        else:
+            logging.warning(f"REPLY_LIMITS: неизвестный ключ {scope}")
+    return budgets
+
+class ReplyLimiter:
+    """
+    Токен-бакеты по ключам (область, id). Бакет — [токены, время обновления]; пополнение считается
+    лениво при обращении, а бакеты, которые успели наполниться (то же самое, что их отсутствие),
+    раз в REPLY_LIMITER_SWEEP_EVERY проверок удаляются — память не растёт от каждого нового автора.
+    """
+
+    def __init__(self, budgets: Dict[str, tuple[float, float]]):
+        # область -> (ёмкость, токенов в секунду)
+        self.budgets = {scope: (capacity, capacity / period) for scope, (capacity, period) in budgets.items()}
+        self.periods = dict(budgets)
+        self._buckets: Dict[tuple, list[float]] = {}
+        self._checks = 0
+        self.allowed = 0
+        self.dropped_by_trigger: Dict[str, int] = {}
+        self.dropped_by_scope: Dict[str, int] = {scope: 0 for scope in budgets}
+
+    def _level(self, key: tuple, now: float) -> float:
+        capacity, rate = self.budgets[key[0]]
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return capacity
+        return min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+    def allow(self, trigger: str, user_id: int, channel_id: int) -> bool:
+        """Можно ли ответить сейчас; при True списывает по токену из всех трёх бакетов."""
+        now = time.monotonic()
+        keys = (("user", user_id), ("channel", channel_id), ("trigger", trigger))
+        levels = [self._level(key, now) for key in keys]
+        self._checks += 1
+        if self._checks % REPLY_LIMITER_SWEEP_EVERY == 0:
+            self._sweep(now)
+
+        for key, level in zip(keys, levels):
+            if level < 1.0:
+                self.dropped_by_scope[key[0]] += 1
+                self.dropped_by_trigger[trigger] = self.dropped_by_trigger.get(trigger, 0) + 1
+                return False
+        for key, level in zip(keys, levels):
+            self._buckets[key] = [level - 1.0, now]
+        self.allowed += 1
+        return True
+
+    def _sweep(self, now: float) -> None:
+        full = [key for key in self._buckets if self._level(key, now) >= self.budgets[key[0]][0]]
+        for key in full:
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+reply_limiter = ReplyLimiter(_load_reply_limits())
+
+# ------------------ auto-reply setup ------------------
+# ссылки на гифки (tenor и медиа discord) — для ответа тем, у кого нет прав прикреплять файлы
+GIF_LINK_RE = re.compile(r"https?://(?:www\.)?tenor\.com|https://media\.discordapp\.net/", re.IGNORECASE)
+
+# ------------------ delayed deletion setup ------------------
+# Удаление ответов бота через N секунд (delete_after авто-ответов).
+# Вместо отдельной спящей задачи на каждое сообщение — одна куча сроков и один фоновый цикл.
+# Сроки пишутся в pending_deletions (с отложенной записью, как счётчики), поэтому переживают рестарт.
+# Созревшие сообщения удаляются пачками по каналу через delete_messages (до 100 за запрос).
+DELETION_TICK = 1.0                    # сек: точность срока удаления и период записи в БД
+DELETION_BULK_MAX = 100                # лимит Discord на одно массовое удаление
+DELETION_BULK_MAX_AGE = 13 * 24 * 3600 # массово удаляются только сообщения младше 14 дней (с запасом)
+DELETION_RETRY_DELAY = 60.0            # сек: через сколько повторить неудавшееся удаление
+DELETION_MAX_ATTEMPTS = 3              # после стольких неудач сообщение снимается с учёта
+
+def _init_deletions_table():
+    with db.transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                message_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                delete_at REAL NOT NULL
+            );
+        """)
+
+_init_deletions_table()
+
+class DeletionScheduler:
+    def __init__(self, rows: list[tuple]):
+        # (delete_at — unix time, message_id, channel_id)
+        self._heap: list[tuple[float, int, int]] = [(float(at), int(mid), int(cid)) for mid, cid, at in rows]
+        heapq.heapify(self._heap)
+        self._new_rows: list[tuple[int, int, float]] = []
+        self._done_ids: list[int] = []
+        self._attempts: Dict[int, int] = {}  # message_id -> неудачных попыток
+        self.processed = 0  # удалено или удалить не вышло — строка снята с учёта
+        self.bulk_requests = 0
+
+    def schedule(self, channel_id: int, message_id: int, delay: float) -> None:
+        delete_at = time.time() + delay
+        heapq.heappush(self._heap, (delete_at, message_id, channel_id))
+        self._new_rows.append((message_id, channel_id, delete_at))
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def _take_due(self, now: float) -> Dict[int, list[int]]:
+        due: Dict[int, list[int]] = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, message_id, channel_id = heapq.heappop(self._heap)
+            due.setdefault(channel_id, []).append(message_id)
+        return due
+
+    def _delete_due(self) -> None:
+        due = self._take_due(time.time())
+        for channel_id, message_ids in due.items():
+            channel = bot.get_channel(channel_id)
+            if channel is None:
+                self._finish(message_ids)  # канал удалён или бот больше не на сервере
+                continue
+            fresh, old = [], []
+            # массовое удаление требует Manage Messages даже для своих сообщений; без него — по одному
+            guild = getattr(channel, "guild", None)
+            if hasattr(channel, "delete_messages") and guild is not None \
+                    and channel.permissions_for(guild.me).manage_messages:
+                bulk_after = time.time() - DELETION_BULK_MAX_AGE
+                for message_id in message_ids:
+                    (fresh if discord.utils.snowflake_time(message_id).timestamp() > bulk_after else old).append(message_id)
+            else:
+                old = message_ids
+            for i in range(0, len(fresh), DELETION_BULK_MAX):
+                chunk = fresh[i:i + DELETION_BULK_MAX]
+                self._submit(channel_id, chunk, lambda channel=channel, chunk=chunk: self._delete_bulk(channel, chunk))
+                self.bulk_requests += 1
+            for message_id in old:
+                self._submit_single(channel, message_id)
+
+    def _submit_single(self, channel, message_id: int) -> None:
+        self._submit(channel.id, [message_id], lambda: self._delete_one(channel, message_id))
+
+    async def _delete_bulk(self, channel, message_ids: list[int]) -> bool:
+        """True — удалено; False — права отобрали, сообщения переставлены в очередь по одному."""
+        try:
+            await channel.delete_messages([discord.Object(id=m) for m in message_ids])
+        except discord.Forbidden:
+            for message_id in message_ids:
+                self._submit_single(channel, message_id)
+            return False
+        return True
+
+    @staticmethod
+    async def _delete_one(channel, message_id: int) -> bool:
+        try:
+            await channel.get_partial_message(message_id).delete()
+        except discord.NotFound:
+            pass  # уже удалено вручную
+        return True
+
+    def _submit(self, channel_id: int, message_ids: list[int], factory) -> None:
+        future = outbound.submit(("delete", channel_id), factory, SendPriority.LOW, stale_after=None)
+
+        def _done(fut):
+            # None — запрос не прошёл (очередь уже записала ошибку в лог)
+            result = fut.result()
+            if result is True:
+                self._finish(message_ids)
+            elif result is None:
+                self._retry(channel_id, message_ids)
+
+        future.add_done_callback(_done)
+
+    def _finish(self, message_ids: list[int]) -> None:
+        self.processed += len(message_ids)
+        self._done_ids.extend(message_ids)
+        for message_id in message_ids:
+            self._attempts.pop(message_id, None)
+
+    def _retry(self, channel_id: int, message_ids: list[int]) -> None:
+        """Запрос не прошёл (ошибка Discord, сеть) — повторить позже, но не бесконечно."""
+        delete_at = time.time() + DELETION_RETRY_DELAY
+        for message_id in message_ids:
+            attempts = self._attempts.get(message_id, 0) + 1
+            if attempts >= DELETION_MAX_ATTEMPTS:
+                self._finish([message_id])
+                continue
+            self._attempts[message_id] = attempts
+            heapq.heappush(self._heap, (delete_at, message_id, channel_id))
+
+    def _take_rows(self) -> tuple[list, list]:
+        new_rows, self._new_rows = self._new_rows, []
+        done_ids, self._done_ids = self._done_ids, []
+        return new_rows, [(m,) for m in done_ids]
+
+    @staticmethod
+    def _write(cur, new_rows: list, done_rows: list) -> None:
+        # сначала вставки: сообщение может созреть раньше, чем его строка попала в БД
+        cur.executemany("INSERT OR REPLACE INTO pending_deletions (message_id, channel_id, delete_at) VALUES (?, ?, ?);", new_rows)
+        cur.executemany("DELETE FROM pending_deletions WHERE message_id = ?;", done_rows)
+
+    async def flush(self) -> None:
+        new_rows, done_rows = self._take_rows()
+        if new_rows or done_rows:
+            await adb.run(lambda cur: self._write(cur, new_rows, done_rows))
+
+    def flush_sync(self) -> None:
+        """То же, что flush, но синхронно — для выхода через os._exit."""
+        new_rows, done_rows = self._take_rows()
+        if new_rows or done_rows:
+            with db.transaction() as cur:
+                self._write(cur, new_rows, done_rows)
+
+    async def run(self) -> None:
+        """Фоновая задача: удаляет созревшие сообщения и сбрасывает сроки на диск."""
+        while True:
+            delay = DELETION_TICK
+            if self._heap:
+                delay = min(delay, max(0.0, self._heap[0][0] - time.time()))
+            await asyncio.sleep(delay)
+            try:
+                self._delete_due()
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка при удалении сообщений по таймеру: {e}")
+
+deletions = DeletionScheduler(db.fetchall("SELECT message_id, channel_id, delete_at FROM pending_deletions;"))
+
+async def reply_expiring(message: discord.Message, content: str, delete_after: Optional[float]) -> discord.Message:
+    """message.reply, но удаление через delete_after секунд ставится в общий планировщик."""
+    sent = await message.reply(content, mention_author=True)
+    if delete_after is not None:
+        deletions.schedule(sent.channel.id, sent.id, delete_after)
+    return sent
 
 # ------------------ Counting chanel setup ------------------
+COUNTER_FLUSH_INTERVAL = 5.0  # сек: как часто сбрасывать next_expected на диск
+
 def _init_counter_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS counter_single (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            channel_id INTEGER,
-            next_expected INTEGER NOT NULL
-        );
-    """)
-    # гарантируем одну строку с id=1
-    cur.execute("INSERT OR IGNORE INTO counter_single (id, channel_id, next_expected) VALUES (1, NULL, 1);")
-    conn.commit()
-    conn.close()
+    with db.transaction() as cur:
+        # старая таблица единственного счётчика (нужна только для переноса)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS counter_single (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                channel_id INTEGER,
+                next_expected INTEGER NOT NULL
+            );
+        """)
+        # счётчики по каналам; seq — номер последнего записанного изменения (для отложенной записи)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS counters (
+                guild_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                next_expected INTEGER NOT NULL,
+                seq INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (guild_id, channel_id)
+            );
+        """)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_counters_channel ON counters (channel_id);")
+        # последнее обработанное сообщение — с него начинается догонялка после рестарта
+        columns = {row[1] for row in cur.execute("PRAGMA table_info(counters);")}
+        if "last_message_id" not in columns:
+            cur.execute("ALTER TABLE counters ADD COLUMN last_message_id INTEGER;")
+
+        # перенос единственного счётчика из counter_single (в этой версии он всегда был в GUILD_ID)
+        cur.execute("SELECT channel_id, next_expected FROM counter_single WHERE id = 1;")
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            cur.execute(
+                "INSERT OR IGNORE INTO counters (guild_id, channel_id, next_expected, seq) VALUES (?, ?, ?, 0);",
+                (GUILD_ID, row[0], row[1])
+            )
+            cur.execute("UPDATE counter_single SET channel_id = NULL WHERE id = 1;")
+            logging.info(f"Счётчик канала {row[0]} перенесён в таблицу counters")
 
 _init_counter_table()
 
-def set_counter_channel(channel_id: Optional[int], start_value: int = 1) -> None:
-    """Установить (или переназначить) канал счётчика. Один канал в системе."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE counter_single SET channel_id = ?, next_expected = ? WHERE id = 1;", (channel_id, start_value))
-    conn.commit()
-    conn.close()
-
-def unset_counter_channel() -> None:
-    """Отключить канал счётчика (делает channel_id NULL)."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE counter_single SET channel_id = NULL WHERE id = 1;")
-    conn.commit()
-    conn.close()
-
-def get_counter_state() -> Optional[tuple[int, int]]:
+class Counter:
     """
-    Возвращает (channel_id, next_expected) или None, если channel_id NULL.
+    Состояние счётчика одного канала в памяти.
+    Каждое изменение увеличивает seq; на диск next_expected пишется пачкой раз в
+    COUNTER_FLUSH_INTERVAL и при выключении, вместе с seq. В UPDATE стоит условие
+    seq < нового, так что запоздавшая старая запись не перетрёт более новую.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT channel_id, next_expected FROM counter_single WHERE id = 1;")
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    channel_id, next_expected = row
-    if channel_id is None:
+
+    __slots__ = ("guild_id", "channel_id", "next_expected", "seq", "flushed_seq", "last_message_id")
+
+    def __init__(self, guild_id: int, channel_id: int, next_expected: int, seq: int = 0, last_message_id: Optional[int] = None):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.next_expected = next_expected
+        self.seq = seq
+        self.flushed_seq = seq
+        self.last_message_id = last_message_id
+
+    @property
+    def dirty(self) -> bool:
+        return self.seq != self.flushed_seq
+
+# channel_id -> Counter: "это counting канал?" — один поиск в dict на сообщение
+_counters: Dict[int, Counter] = {
+    int(channel_id): Counter(int(guild_id), int(channel_id), int(next_expected), int(seq), last_message_id)
+    for guild_id, channel_id, next_expected, seq, last_message_id
+    in db.fetchall("SELECT guild_id, channel_id, next_expected, seq, last_message_id FROM counters;")
+}
+
+# каналы, которые после старта надо догнать по истории; до конца догонялки новые сообщения ждут в очереди
+_counting_catchup_pending: set[int] = {c.channel_id for c in _counters.values() if c.last_message_id is not None}
+
+_COUNTER_UPDATE_SQL = "UPDATE counters SET next_expected = ?, seq = ?, last_message_id = ? WHERE channel_id = ? AND seq < ?;"
+
+def _dirty_counter_rows() -> list[tuple]:
+    return [(c.next_expected, c.seq, c.last_message_id, c.channel_id, c.seq) for c in _counters.values() if c.dirty]
+
+def _mark_counters_flushed(rows: list[tuple]) -> None:
+    for _, seq, _, channel_id, _ in rows:
+        counter = _counters.get(channel_id)
+        if counter is not None:
+            counter.flushed_seq = max(counter.flushed_seq, seq)
+
+async def flush_counters() -> None:
+    """Записать все изменившиеся счётчики одной транзакцией."""
+    rows = _dirty_counter_rows()
+    if not rows:
+        return
+    await adb.executemany(_COUNTER_UPDATE_SQL, rows)
+    _mark_counters_flushed(rows)
+
+def flush_counters_sync() -> None:
+    """То же, что flush_counters, но синхронно — для выхода через os._exit."""
+    rows = _dirty_counter_rows()
+    if not rows:
+        return
+    db.executemany(_COUNTER_UPDATE_SQL, rows)
+    _mark_counters_flushed(rows)
+
+async def counter_flush_loop():
+    """Фоновая задача: периодически сбрасывает состояние и статистику счётчиков на диск."""
+    while True:
+        await asyncio.sleep(COUNTER_FLUSH_INTERVAL)
+        try:
+            await flush_counters()
+            await flush_counter_stats()
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении счётчика: {e}")
+
+async def set_counter_channel(guild_id: int, channel_id: int, start_value: int = 1) -> None:
+    """Установить (или перезапустить) счётчик в канале."""
+    previous = _counters.get(channel_id)
+    known_seq = previous.seq if previous else 0
+
+    def write(cur) -> int:
+        # seq берём не меньше сохранённого: иначе отставший сброс со старым seq
+        # отсёк бы обновления нового счётчика условием "seq < ?"
+        row = cur.execute("SELECT seq FROM counters WHERE channel_id = ?;", (channel_id,)).fetchone()
+        seq = max(known_seq, row[0] if row else 0) + 1
+        cur.execute(
+            "INSERT OR REPLACE INTO counters (guild_id, channel_id, next_expected, seq) VALUES (?, ?, ?, ?);",
+            (guild_id, channel_id, start_value, seq)
+        )
+        return seq
+
+    # настройку пишем сразу, а не с периодическим сбросом
+    seq = await adb.run(write)
+    _counters[channel_id] = Counter(guild_id, channel_id, start_value, seq)
+
+async def unset_counter_channel(channel_id: int) -> bool:
+    """Отключить счётчик в канале. Возвращает False, если счётчика там не было."""
+    if _counters.pop(channel_id, None) is None:
+        return False
+    await adb.execute("DELETE FROM counters WHERE channel_id = ?;", (channel_id,))
+    return True
+
+def get_counter_state(channel_id: int) -> Optional[tuple[int, int]]:
+    """
+    Возвращает (channel_id, next_expected) или None, если в канале нет счётчика.
+    """
+    counter = _counters.get(channel_id)
+    if counter is None:
         return None
-    return (int(channel_id), int(next_expected))
+    return (counter.channel_id, counter.next_expected)
 
+def is_counting_channel(channel_id: int) -> bool:
+    return channel_id in _counters
 
+def inc_counter(channel_id: int) -> None:
+    """Увеличить next_expected на 1 (на диск попадёт при следующем сбросе)."""
+    counter = _counters[channel_id]
+    counter.next_expected += 1
+    counter.seq += 1
 
-def inc_counter() -> None:
-    """Увеличить next_expected на 1."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE counter_single SET next_expected = next_expected + 1 WHERE id = 1;")
-    conn.commit()
-    conn.close()
+COUNTING_REORDER_DELAY = 0.05  # сек: сколько ждать опоздавшие сообщения перед проверкой пачки
+COUNTING_CATCHUP_PAGE = 500     # сообщений истории на одну пачку/контрольную точку догонялки
 
+def evaluate_counting_expression(expr: str) -> Optional[float]:
+    """Вычисляет сообщение counting канала (те же функции что и /calculate). None — не число/ошибка."""
+    try:
+        return float(calc_evaluate(expr.strip()))
+    except Exception:
+        return None  # ошибка парсинга/вычисления или неизвестные идентификаторы — игнорируем
 
+def _send_counting_verdict(message: discord.Message, ok: bool, expected: int, from_history: bool = False) -> None:
+    # при догонялке сообщение могло быть уже обработано до падения — второй раз не отвечаем
+    if from_history and any(r.me for r in getattr(message, "reactions", ())):
+        return
+    channel_id = message.channel.id
+    # реакции — вердикт по конкретному сообщению, они не устаревают и не схлопываются
+    outbound.submit(("reaction", channel_id), lambda: message.add_reaction("✅" if ok else "⚠️"),
+                    SendPriority.NORMAL, stale_after=None)
+    if ok:
+        return
+    if not reply_limiter.allow("counting_warning", message.author.id, channel_id):
+        return  # реакция ⚠️ уже стоит, а текстом во время флуда не отвечаем
+    # из нескольких ошибок подряд актуальна только подсказка к последней
+    text = f"Ожидаемое предыдущее число: **{int(expected - 1)}**"
+    outbound.submit(("channel", channel_id), lambda: message.channel.send(text),
+                    SendPriority.NORMAL, coalesce_key=("counting_warning", channel_id))
+
+class CountingSequencer:
+    """
+    Очередь сообщений одного counting канала.
+    Сообщения копятся в куче по snowflake ID, через COUNTING_REORDER_DELAY пачка вычисляется
+    в потоке (не на event loop), после чего проверка и inc_counter для всей пачки выполняются
+    подряд без await между ними — два одновременных "5" не получат оба ✅.
+    Реакции и ответы отправляются отдельными задачами и не задерживают следующую пачку.
+
+    После рестарта новые сообщения ждут, пока catch_up не обработает историю канала,
+    пропущенную за время простоя (с last_message_id счётчика).
+    """
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self._heap: list[tuple[int, discord.Message]] = []
+        self._worker: Optional[asyncio.Task] = None
+        self._open = asyncio.Event()
+        if channel_id not in _counting_catchup_pending:
+            self._open.set()
+
+    def submit(self, message: discord.Message) -> None:
+        heapq.heappush(self._heap, (message.id, message))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._heap:
+            await asyncio.sleep(COUNTING_REORDER_DELAY)
+            await self._open.wait()
+            batch = [heapq.heappop(self._heap)[1] for _ in range(len(self._heap))]
+            await self._process(batch)
+
+    async def _process(self, batch: list, from_history: bool = False) -> None:
+        loop = asyncio.get_running_loop()
+        values = await loop.run_in_executor(
+            None, lambda: [evaluate_counting_expression(m.content or "") for m in batch]
+        )
+        # проверка + инкремент без await: атомарно относительно других корутин
+        verdicts = []
+        for message, value in zip(batch, values):
+            counter = _counters.get(self.channel_id)
+            if counter is None:
+                return
+            if counter.last_message_id is not None and message.id <= counter.last_message_id:
+                continue  # уже обработано (например, пришло и из истории, и с gateway)
+            counter.last_message_id = message.id
+            counter.seq += 1
+            if value is None or message.author.bot:
+                continue
+            expected = counter.next_expected
+            ok = abs(value - expected) <= COUNTER_TOLERANCE
+            if ok:
+                inc_counter(self.channel_id)
+            record_count(self.channel_id, message.author.id, ok, expected, getattr(message, "created_at", None))
+            verdicts.append((message, ok, expected))
+        for message, ok, expected in verdicts:
+            _send_counting_verdict(message, ok, expected, from_history)
+
+    async def catch_up(self, channel) -> int:
+        """
+        Обрабатывает сообщения, пришедшие пока бот был выключен.
+        История читается страницами, каждые COUNTING_CATCHUP_PAGE сообщений состояние
+        пишется одной транзакцией — прерванная догонялка продолжится с этой точки.
+        Возвращает число просмотренных сообщений.
+        """
+        seen = 0
+        try:
+            counter = _counters.get(self.channel_id)
+            if counter is None or counter.last_message_id is None:
+                return 0
+            page = []
+            async for message in channel.history(limit=None, after=discord.Object(id=counter.last_message_id), oldest_first=True):
+                page.append(message)
+                if len(page) >= COUNTING_CATCHUP_PAGE:
+                    await self._process(page, from_history=True)
+                    await flush_counters()
+                    seen += len(page)
+                    page = []
+            if page:
+                await self._process(page, from_history=True)
+                await flush_counters()
+                seen += len(page)
+            return seen
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        """Пропустить живые сообщения (догонялка закончена или невозможна)."""
+        _counting_catchup_pending.discard(self.channel_id)
+        self._open.set()
+
+_counting_sequencers: Dict[int, CountingSequencer] = {}
+
+def get_counting_sequencer(channel_id: int) -> CountingSequencer:
+    sequencer = _counting_sequencers.get(channel_id)
+    if sequencer is None:
+        sequencer = _counting_sequencers[channel_id] = CountingSequencer(channel_id)
+    return sequencer
+
+async def catch_up_counters() -> None:
+    """Догоняет все counting каналы после старта (вызывается из on_ready)."""
+    async def _one(channel_id: int):
+        sequencer = get_counting_sequencer(channel_id)
+        try:
+            channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+            seen = await sequencer.catch_up(channel)
+            if seen:
+                logging.info(f"Counting {channel_id}: обработано пропущенных сообщений: {seen}")
+        except Exception as e:
+            logging.error(f"Ошибка догонялки counting канала {channel_id}: {e}")
+        finally:
+            # даже при ошибке не держим живые сообщения вечно
+            sequencer.release()
+
+    await asyncio.gather(*(_one(channel_id) for channel_id in list(_counting_catchup_pending)))
+
+# ------------------ Counting stats setup ------------------
+# Статистика считается по ходу проверки сообщений и пишется в БД вместе со счётчиками,
+# /counter_stats и /counter_top читают только память — историю канала никто не пересчитывает.
+COUNTER_HOURS_KEPT = 48  # сколько часов почасовой статистики держать в памяти
+
+def _init_counter_stats_tables():
+    with db.transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS counter_stats (
+                channel_id INTEGER PRIMARY KEY,
+                total_correct INTEGER NOT NULL DEFAULT 0,
+                total_incorrect INTEGER NOT NULL DEFAULT 0,
+                current_streak INTEGER NOT NULL DEFAULT 0,
+                best_streak INTEGER NOT NULL DEFAULT 0,
+                best_number INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS counter_user_stats (
+                channel_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                correct INTEGER NOT NULL DEFAULT 0,
+                incorrect INTEGER NOT NULL DEFAULT 0,
+                streak INTEGER NOT NULL DEFAULT 0,
+                best_streak INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (channel_id, user_id)
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS counter_hourly (
+                channel_id INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                correct INTEGER NOT NULL DEFAULT 0,
+                incorrect INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (channel_id, hour)
+            );
+        """)
+
+_init_counter_stats_tables()
+
+class CounterStats:
+    """Агрегаты одного counting канала: итоги, серии, рекорд, по участникам и по часам."""
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.total_correct = 0
+        self.total_incorrect = 0
+        self.current_streak = 0
+        self.best_streak = 0
+        self.best_number = 0
+        # user_id -> [correct, incorrect, streak, best_streak]
+        self.users: Dict[int, list[int]] = {}
+        # hour (unix // 3600) -> [correct, incorrect]
+        self.hours: Dict[int, list[int]] = {}
+        self.dirty = False
+        self.dirty_users: set[int] = set()
+        self.dirty_hours: set[int] = set()
+
+    def record(self, user_id: int, ok: bool, number: int, hour: int) -> None:
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = [0, 0, 0, 0]
+        bucket = self.hours.get(hour)
+        if bucket is None:
+            bucket = self.hours[hour] = [0, 0]
+        if ok:
+            self.total_correct += 1
+            self.current_streak += 1
+            self.best_streak = max(self.best_streak, self.current_streak)
+            self.best_number = max(self.best_number, number)
+            user[0] += 1
+            user[2] += 1
+            user[3] = max(user[3], user[2])
+            bucket[0] += 1
+        else:
+            self.total_incorrect += 1
+            self.current_streak = 0
+            user[1] += 1
+            user[2] = 0
+            bucket[1] += 1
+        self.dirty = True
+        self.dirty_users.add(user_id)
+        self.dirty_hours.add(hour)
+
+    def top(self, limit: int = 10) -> list[tuple[int, list[int]]]:
+        return heapq.nlargest(limit, self.users.items(), key=lambda item: item[1][0])
+
+    def last_hours(self, hours: int, now_hour: int) -> tuple[int, int]:
+        correct = incorrect = 0
+        for hour in range(now_hour - hours + 1, now_hour + 1):
+            bucket = self.hours.get(hour)
+            if bucket:
+                correct += bucket[0]
+                incorrect += bucket[1]
+        return correct, incorrect
+
+def _load_counter_stats() -> Dict[int, CounterStats]:
+    stats: Dict[int, CounterStats] = {}
+    for channel_id, total_correct, total_incorrect, current_streak, best_streak, best_number in db.fetchall(
+            "SELECT channel_id, total_correct, total_incorrect, current_streak, best_streak, best_number FROM counter_stats;"):
+        st = stats[channel_id] = CounterStats(channel_id)
+        st.total_correct, st.total_incorrect = total_correct, total_incorrect
+        st.current_streak, st.best_streak, st.best_number = current_streak, best_streak, best_number
+    for channel_id, user_id, correct, incorrect, streak, best_streak in db.fetchall(
+            "SELECT channel_id, user_id, correct, incorrect, streak, best_streak FROM counter_user_stats;"):
+        stats.setdefault(channel_id, CounterStats(channel_id)).users[user_id] = [correct, incorrect, streak, best_streak]
+    min_hour = int(time.time() // 3600) - COUNTER_HOURS_KEPT
+    for channel_id, hour, correct, incorrect in db.fetchall(
+            "SELECT channel_id, hour, correct, incorrect FROM counter_hourly WHERE hour >= ?;", (min_hour,)):
+        stats.setdefault(channel_id, CounterStats(channel_id)).hours[hour] = [correct, incorrect]
+    return stats
+
+_counter_stats: Dict[int, CounterStats] = _load_counter_stats()
+
+def record_count(channel_id: int, user_id: int, ok: bool, number: int, created_at=None) -> None:
+    """Учесть проверенное сообщение counting канала в статистике (только память)."""
+    st = _counter_stats.get(channel_id)
+    if st is None:
+        st = _counter_stats[channel_id] = CounterStats(channel_id)
+    timestamp = created_at.timestamp() if created_at is not None else time.time()
+    st.record(user_id, ok, number, int(timestamp // 3600))
+
+def _take_counter_stats_rows() -> tuple[list, list, list]:
+    """Забирает изменившиеся агрегаты для записи и сбрасывает пометки."""
+    channel_rows, user_rows, hour_rows = [], [], []
+    min_hour = int(time.time() // 3600) - COUNTER_HOURS_KEPT
+    for st in _counter_stats.values():
+        if not st.dirty:
+            continue
+        channel_rows.append((st.channel_id, st.total_correct, st.total_incorrect, st.current_streak, st.best_streak, st.best_number))
+        user_rows.extend((st.channel_id, uid, *st.users[uid]) for uid in st.dirty_users)
+        hour_rows.extend((st.channel_id, hour, *st.hours[hour]) for hour in st.dirty_hours)
+        st.dirty = False
+        st.dirty_users.clear()
+        st.dirty_hours.clear()
+        for hour in [h for h in st.hours if h < min_hour]:
+            del st.hours[hour]
+    return channel_rows, user_rows, hour_rows
+
+def _mark_counter_stats_dirty(channel_rows: list, user_rows: list, hour_rows: list) -> None:
+    """Запись не удалась — вернуть пометки, чтобы агрегаты ушли со следующим сбросом."""
+    for row in channel_rows:
+        st = _counter_stats.get(row[0])
+        if st is not None:
+            st.dirty = True
+    for channel_id, uid, *_ in user_rows:
+        st = _counter_stats.get(channel_id)
+        if st is not None and uid in st.users:
+            st.dirty_users.add(uid)
+    for channel_id, hour, *_ in hour_rows:
+        st = _counter_stats.get(channel_id)
+        if st is not None and hour in st.hours:
+            st.dirty_hours.add(hour)
+
+def _write_counter_stats(cur, channel_rows: list, user_rows: list, hour_rows: list) -> None:
+    cur.executemany("INSERT OR REPLACE INTO counter_stats VALUES (?, ?, ?, ?, ?, ?);", channel_rows)
+    cur.executemany("INSERT OR REPLACE INTO counter_user_stats VALUES (?, ?, ?, ?, ?, ?);", user_rows)
+    cur.executemany("INSERT OR REPLACE INTO counter_hourly VALUES (?, ?, ?, ?);", hour_rows)
+
+async def flush_counter_stats() -> None:
+    """Записать изменившуюся статистику одной транзакцией."""
+    rows = _take_counter_stats_rows()
+    if not rows[0]:
+        return
+    try:
+        await adb.run(lambda cur: _write_counter_stats(cur, *rows))
+    except Exception:
+        _mark_counter_stats_dirty(*rows)
+        raise
+
+def flush_counter_stats_sync() -> None:
+    """То же, что flush_counter_stats, но синхронно — для выхода через os._exit."""
+    rows = _take_counter_stats_rows()
+    if not rows[0]:
+        return
+    try:
+        with db.transaction() as cur:
+            _write_counter_stats(cur, *rows)
+    except Exception:
+        _mark_counter_stats_dirty(*rows)
+        raise
+
+# ------------------ message dispatch setup ------------------
+# on_message не гоняет каждое сообщение через все обработчики по очереди: у каждого обработчика
+# есть дешёвый синхронный фильтр (канал из множества, префикс, совпадение триггера), и запускаются
+# только те, чей фильтр сработал — параллельно, каждый со своим таймаутом, ошибка одного
+# не мешает остальным. Задержки обработчиков видны в /dispatch_stats.
+DISPATCH_LATENCY_SAMPLES = 256  # по скольким последним вызовам считать перцентили
+
+class MessageHandler:
+    __slots__ = ("name", "prefilter", "handler", "timeout", "calls", "skipped", "errors", "timeouts", "max_time", "latencies")
+
+    def __init__(self, name: str, prefilter, handler, timeout: float):
+        self.name = name
+        self.prefilter = prefilter  # message -> подсказка для обработчика или None/False
+        self.handler = handler      # async (message, подсказка)
+        self.timeout = timeout
+        self.calls = 0
+        self.skipped = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.max_time = 0.0
+        self.latencies: deque = deque(maxlen=DISPATCH_LATENCY_SAMPLES)
+
+    def percentile(self, q: float) -> float:
+        return _percentile(self.latencies, q)
+
+class MessageDispatcher:
+    def __init__(self):
+        self.handlers: list[MessageHandler] = []
+
+    def register(self, name: str, prefilter, handler, timeout: float) -> None:
+        self.handlers.append(MessageHandler(name, prefilter, handler, timeout))
+
+    async def _run(self, entry: MessageHandler, message: discord.Message, hint) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(entry.handler(message, hint), entry.timeout)
+        except asyncio.TimeoutError:
+            entry.timeouts += 1
+            logging.warning(f"Обработчик сообщений {entry.name} не уложился в {entry.timeout:g} с (сообщение {message.id})")
+        except Exception as e:
+            entry.errors += 1
+            logging.error(f"Ошибка в обработчике сообщений {entry.name}: {e!r}")
+        finally:
+            elapsed = time.perf_counter() - started
+            entry.calls += 1
+            entry.max_time = max(entry.max_time, elapsed)
+            entry.latencies.append(elapsed)
+
+    async def dispatch(self, message: discord.Message) -> None:
+        runs = []
+        for entry in self.handlers:
+            try:
+                hint = entry.prefilter(message)
+            except Exception as e:
+                entry.errors += 1
+                logging.error(f"Ошибка в фильтре обработчика {entry.name}: {e!r}")
+                continue
+            if hint:
+                runs.append(self._run(entry, message, hint))
+            else:
+                entry.skipped += 1
+        if runs:
+            await asyncio.gather(*runs)
+
+message_dispatcher = MessageDispatcher()
+
+def _command_prefilter(message: discord.Message) -> bool:
+    prefix = bot.command_prefix
+    if isinstance(prefix, str):
+        return (message.content or "").startswith(prefix)
+    return True  # префикс-функция или список — пусть решает process_commands
 
 
 # ----------------------------
@@ -590,6 +1941,36 @@ async def clear_local_slash():
         return False
 
 # ------------------ restart process setup ------------------
+def flush_state():
+    """Записывает всё отложенное (права, очередь БД, счётчик) перед os._exit."""
+    try:
+        flush_perms()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении прав: {e}")
+    try:
+        adb.close()
+    except Exception as e:
+        logging.error(f"Ошибка при остановке потока БД: {e}")
+    try:
+        flush_counters_sync()
+        flush_counter_stats_sync()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении счётчика: {e}")
+    try:
+        deletions.flush_sync()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении отложенных удалений: {e}")
+    calc_sandbox.close()
+
+_background_tasks: Dict[str, asyncio.Task] = {}
+
+def start_background_tasks():
+    """Запускает фоновые задачи (из on_ready; повторный on_ready после реконнекта их не дублирует)."""
+    for name, factory in (("counter_flush", counter_flush_loop), ("deletions", deletions.run)):
+        task = _background_tasks.get(name)
+        if task is None or task.done():
+            _background_tasks[name] = asyncio.create_task(factory(), name=name)
+
 async def restart_process(interaction_or_ctx=None):
     """
     Сохраняет канал (если interaction_or_ctx передан), отвечает пользователю и перезапускает процесс.
@@ -613,7 +1994,7 @@ async def restart_process(interaction_or_ctx=None):
         logging.exception(f"Ошибка при подготовке ответа перед рестартом: {e}")
 
     try:
-        save_restart_channel(int(channel_id) if channel_id is not None else None)
+        await save_restart_channel(int(channel_id) if channel_id is not None else None)
     except Exception as e:
         logging.exception(f"Ошибка при сохранении channel_id в БД: {e}")
 
@@ -628,6 +2009,9 @@ async def restart_process(interaction_or_ctx=None):
     # Небольшая пауза перед завершением
     await asyncio.sleep(0.5)
 
+    # os._exit не вызывает atexit — сохраняем отложенные изменения явно
+    flush_state()
+
     # Завершаем процесс бота (start.py автоматически перезапустит его с обновлением файлов)
     logging.info("Завершение процесса для перезапуска...")
     os._exit(0)
@@ -653,7 +2037,7 @@ async def quickrestart_process(interaction_or_ctx=None):
         pass
 
     # сохраняем в БД канал (может быть None)
-    save_restart_channel(int(channel_id) if channel_id is not None else None)
+    await save_restart_channel(int(channel_id) if channel_id is not None else None)
 
     # создаём флаг быстрого перезапуска
     quick_restart_flag = os.path.join(os.path.dirname(__file__), ".quick_restart")
@@ -675,6 +2059,9 @@ async def quickrestart_process(interaction_or_ctx=None):
     # Небольшая пауза перед завершением
     await asyncio.sleep(0.5)
 
+    # os._exit не вызывает atexit — сохраняем отложенные изменения явно
+    flush_state()
+
     # Завершаем процесс бота (start.py перезапустит его БЕЗ обновления файлов)
     logging.info("Завершение процесса для быстрого перезапуска...")
     os._exit(0)
@@ -750,6 +2137,7 @@ def mainbotstart():
 
         await bot.close()
 
+        flush_state()
         os._exit(0)
 
     @bot.command(name="restartbot")
@@ -1026,8 +2414,8 @@ def mainbotstart():
     # ----------------------------
     # SLASH: /calculate expression
     # ----------------------------
-    @bot.tree.command(name="calculate", description="Вычислить математическое выражение.")
-    async def calculate(interaction: discord.Interaction, expression: str):
+    @bot.tree.command(name="calculate", description="Вычислить выражение (или диапазон: sin(x)^2 for x in 0..10 step 0.01).")
+    async def calculate(interaction: discord.Interaction, expression: str, plot: bool = False):
         await interaction.response.defer(ephemeral=False)
 
         expr = expression.strip()
@@ -1035,49 +2423,77 @@ def mainbotstart():
             await interaction.followup.send("Пустое выражение.", ephemeral=True)
             return
 
-        expr = _preprocess(expr)
-
-        try:
-            node = ast.parse(expr, mode='eval')
-        except Exception as e:
-            await interaction.followup.send(f"Синтаксическая ошибка: {e}", ephemeral=True)
+        if parse_range(expr) is not None:
+            await calculate_range(interaction, expression, expr, plot)
             return
 
         try:
-            _check_nodes(node)
-        except Exception as e:
-            await interaction.followup.send(f"Недопустимый элемент в выражении: {e}", ephemeral=True)
+            if calc_prepare(expr).heavy:
+                # огромные числа: вычисление и перевод в текст — в песочнице, не в event loop
+                out, is_number = await calc_sandbox.evaluate(expr)
+            else:
+                value = calc_evaluate(expr)
+                try:
+                    out, is_number = format_result(value), isinstance(value, (int, float, complex))
+                except ValueError:
+                    # оценка промахнулась и число не влезло в лимит int->str — переводим в текст в песочнице
+                    out, is_number = await calc_sandbox.evaluate(expr)
+        except CalcError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
             return
 
-        used = set()
-        _find_names(node, used)
-        unknown = [name for name in used if name not in _SAFE_NAMES]
-        if unknown:
-            await interaction.followup.send(f"Неизвестные идентификаторы: {', '.join(sorted(unknown))}", ephemeral=True)
+        if len(out) > CALC_MAX_MESSAGE_CHARS:
+            file = discord.File(io.BytesIO(out.encode()), filename="result.txt")
+            size = f"число из **{len(out)}** знаков" if is_number else f"строка из **{len(out)}** символов"
+            await interaction.followup.send(
+                f"`{expression}` = {size}, полностью — во вложении.", file=file, ephemeral=False
+            )
             return
 
+        await interaction.followup.send(f"`{expression}` = **{out}**", ephemeral=False)
+
+
+    async def calculate_range(interaction: discord.Interaction, expression: str, expr: str, plot: bool):
+        loop = asyncio.get_running_loop()
         try:
-            result = _eval_node(node)
-        except NameError as ne:
-            await interaction.followup.send(f"Неизвестная функция или константа: {ne}", ephemeral=True)
-            return
-        except Exception as e:
-            await interaction.followup.send(f"Ошибка при вычислении: {e}", ephemeral=True)
+            result = await loop.run_in_executor(None, calc_range, expr)
+        except CalcError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
             return
 
-        if isinstance(result, float):
-            out = f"{result:.12g}"
-        else:
-            out = str(result)
+        text = _format_range_reply(expression, result)
+        files = [discord.File(io.BytesIO(result.to_csv().encode()), filename="range.csv")]
+        if plot:
+            png = await loop.run_in_executor(None, render_range_plot, result, expr)
+            if png is None:
+                text += "\nГрафик недоступен: на сервере не установлен matplotlib."
+            else:
+                files.append(discord.File(io.BytesIO(png), filename="plot.png"))
+        await interaction.followup.send(text, files=files, ephemeral=False)
 
-        await interaction.followup.send(f"`{expression}` = **{out}**", ephemeral=False)
+    @bot.tree.command(name="calc_cache", description="Статистика кэша выражений /calculate (owner only).")
+    async def calc_cache_cmd(interaction: discord.Interaction, clear: bool = False):
+        if not has_perm(interaction.user.id, PermRole.OWNER):
+            await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
+            return
 
+        hits, misses = calc_cache.hits, calc_cache.misses
+        total = hits + misses
+        rate = f"{hits / total:.1%}" if total else "—"
+        text = (
+            f"Кэш выражений: **{len(calc_cache)}/{calc_cache.maxsize}**\n"
+            f"Попаданий: **{hits}**, промахов: **{misses}** (hit rate {rate})"
+        )
+        if clear:
+            calc_cache.clear()
+            text += "\nКэш очищен."
+        await interaction.response.send_message(text, ephemeral=True)
 
     # ----------------------------
     # СЕКЦИЯ COINGING КАНАЛА
     # ----------------------------
     # --- Команды управления счётчиком ---
-    @bot.tree.command(name="set_counter", description="Установить канал для счётчика (owner only).")
+    @bot.tree.command(name="set_counter", description="Установить счётчик в канале (owner only).")
     async def set_counter(interaction: discord.Interaction, channel: discord.TextChannel | None = None, start_value : int | None = None):
         if not has_perm(interaction.user.id, PermRole.OWNER):
             await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
@@ -1088,75 +2504,91 @@ def mainbotstart():
             await interaction.response.send_message("Не удалось определить канал.", ephemeral=True)
             return
 
-        # один канал в системе — просто перезаписываем
-        set_counter_channel(int(target.id), start_value=start_value)
+        if target.guild is None:
+            await interaction.response.send_message("Счётчик можно поставить только в канал сервера.", ephemeral=True)
+            return
+
+        # счётчиков может быть много — по одному на канал, повторный вызов перезапускает
+        await set_counter_channel(int(target.guild.id), int(target.id), start_value=start_value)
         await interaction.response.send_message(f"Счётчик установлен в канал {target.mention}. Начинаем с {start_value}.", ephemeral=True)
 
-    @bot.tree.command(name="unset_counter", description="Отключить канал счётчика (owner only).")
-    async def unset_counter(interaction: discord.Interaction):
+    @bot.tree.command(name="unset_counter", description="Отключить счётчик в канале (owner only).")
+    async def unset_counter(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
         if not has_perm(interaction.user.id, PermRole.OWNER):
             await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
             return
 
-        unset_counter_channel()
-        await interaction.response.send_message("Счётчик отключён.", ephemeral=True)
-    # --- Обработчик входящих сообщений ---
- 
-    async def on_counting_message(message: discord.Message):
-    # игнорируем ботов
-        if message.author.bot:
+        target = channel or interaction.channel
+        if target is None or not await unset_counter_channel(int(target.id)):
+            await interaction.response.send_message("В этом канале нет счётчика.", ephemeral=True)
+            return
+        await interaction.response.send_message(f"Счётчик в {target.mention} отключён.", ephemeral=True)
+    # --- Статистика счётчика ---
+    @bot.tree.command(name="counter_stats", description="Статистика счётчика канала (или участника)")
+    async def counter_stats(interaction: discord.Interaction, channel: discord.TextChannel | None = None, member: discord.Member | None = None):
+        target = channel or interaction.channel
+        st = _counter_stats.get(target.id) if target is not None else None
+        if st is None:
+            await interaction.response.send_message("По этому каналу статистики нет.", ephemeral=True)
             return
 
-        # получаем состояние единственного счётчика
-        cs = get_counter_state()
-        if cs is None:
-            return  # счётчик не настроен
-
-        channel_id, next_expected = cs
-        # работаем только в настроенном канале
-        if message.channel.id != channel_id:
+        if member is not None:
+            user = st.users.get(member.id)
+            if user is None:
+                await interaction.response.send_message(f"{member.mention} ещё не считал в {target.mention}.", ephemeral=True)
+                return
+            correct, incorrect, streak, best_streak = user
+            await interaction.response.send_message(
+                f"**{member.display_name}** в {target.mention}:\n"
+                f"✅ Верно: **{correct}**  ⚠️ Ошибок: **{incorrect}**\n"
+                f"Серия сейчас: **{streak}**, лучшая: **{best_streak}**",
+                ephemeral=True
+            )
             return
 
-        expr = (message.content or "").strip()
-        if not expr:
+        now_hour = int(time.time() // 3600)
+        day_correct, day_incorrect = st.last_hours(24, now_hour)
+        hour_correct, _ = st.last_hours(1, now_hour)
+        state = get_counter_state(target.id)
+        lines = [
+            f"**Счётчик {target.mention}**",
+            f"Следующее число: **{state[1]}**" if state else "Счётчик в канале отключён",
+            f"✅ Верно: **{st.total_correct}**  ⚠️ Ошибок: **{st.total_incorrect}**",
+            f"Серия сейчас: **{st.current_streak}**, рекордная серия: **{st.best_streak}**, рекордное число: **{st.best_number}**",
+            f"За последний час: **{hour_correct}**, за сутки: **{day_correct}** (≈{day_correct / 24:.1f}/час, ошибок {day_incorrect})",
+        ]
+        await interaction.response.send_message("\n".join(lines), ephemeral=False)
+
+    @bot.tree.command(name="counter_top", description="Таблица лидеров счётчика")
+    async def counter_top(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
+        target = channel or interaction.channel
+        st = _counter_stats.get(target.id) if target is not None else None
+        if st is None or not st.users:
+            await interaction.response.send_message("По этому каналу статистики нет.", ephemeral=True)
             return
 
-        # парсим и вычисляем (те же функции что и /calculate)
-        try:
-            expr_proc = _preprocess(expr)
-            node = ast.parse(expr_proc, mode='eval')
-            _check_nodes(node)
-            used = set()
-            _find_names(node, used)
-            unknown = [name for name in used if name not in _SAFE_NAMES]
-            if unknown:
-                return  # неизвестные идентификаторы — игнорируем
-            result = _eval_node(node)
-        except Exception:
-            return  # ошибка парсинга/вычисления — игнорируем
+        lines = [f"**Лидеры счётчика {target.mention}**"]
+        for place, (user_id, (correct, incorrect, _, best_streak)) in enumerate(st.top(10), start=1):
+            lines.append(f"{place}. <@{user_id}> — ✅ {correct}, ⚠️ {incorrect}, лучшая серия {best_streak}")
+        await interaction.response.send_message(
+            "\n".join(lines), ephemeral=False, allowed_mentions=discord.AllowedMentions.none()
+        )
 
-        try:
-            value = float(result)
-        except Exception:
+    # --- Обработчик входящих сообщений ---
+ 
+    async def on_counting_message(message: discord.Message, hint=None):
+        # работаем только в counting каналах (поиск в dict в памяти, без БД)
+        if message.channel.id not in _counters:
+            return
+    # игнорируем ботов
+        if message.author.bot:
             return
 
-        expected = float(next_expected)
-        if abs(value - expected) <= COUNTER_TOLERANCE:
-            try:
-                await message.add_reaction("✅")
-            except Exception:
-                pass
-            inc_counter()
-        else:
-            try:
-                await message.add_reaction("⚠️")
-            except Exception:
-                pass
-            prev_num = expected - 1
-            try:
-                await message.channel.send(f"Ожидаемое предыдущее число: **{int(prev_num)}**")
-            except Exception:
-                pass
+        if not (message.content or "").strip():
+            return
+
+        # проверка и ответы идут через очередь канала строго по порядку сообщений
+        get_counting_sequencer(message.channel.id).submit(message)
 
     # ----------------------------
     # SLASH: /askgpt message
@@ -1414,7 +2846,7 @@ def mainbotstart():
         
         # Сохраняем в БД
         try:
-            save_role_reaction(message.id, channel.id, emoji, role.id)
+            await save_role_reaction(message.id, channel.id, emoji, role.id)
         except Exception as e:
             await interaction.response.send_message(f"❌ Ошибка при сохранении в БД: {e}", ephemeral=True)
             await message.delete()
@@ -1425,6 +2857,169 @@ def mainbotstart():
             ephemeral=True
         )
 
+    # ----------------------------
+    # SLASH: Role Reaction Menu (несколько эмодзи -> ролей на одном сообщении)
+    # ----------------------------
+    @bot.tree.command(name="role_reaction_menu", description="Создать меню ролей: несколько реакций на одном сообщении")
+    @discord.app_commands.describe(
+        pairs="Пары эмодзи и роль через ; например: 🎮 @Игрок; 🎨 @Художник",
+        title="Заголовок сообщения"
+    )
+    async def role_reaction_menu(interaction: discord.Interaction, pairs: str, title: str | None = None):
+        """Создаёт сообщение с несколькими реакциями, каждая выдаёт свою роль."""
+        
+        if interaction.guild is None:
+            await interaction.response.send_message("Эта команда работает только на сервере.", ephemeral=True)
+            return
+
+        if not interaction.user.guild_permissions.manage_roles:
+            await interaction.response.send_message("❌ У вас нет прав на управление ролями.", ephemeral=True)
+            return
+        
+        bot_member = interaction.guild.get_member(bot.user.id)
+        if not bot_member or not bot_member.guild_permissions.manage_roles:
+            await interaction.response.send_message("❌ У бота нет прав на управление ролями.", ephemeral=True)
+            return
+
+        menu, error = parse_role_menu(interaction.guild, bot_member, pairs)
+        if error:
+            await interaction.response.send_message(error, ephemeral=True)
+            return
+        if len(menu) > ROLE_MENU_MAX_PAIRS:
+            await interaction.response.send_message(f"❌ Максимум {ROLE_MENU_MAX_PAIRS} ролей в одном меню.", ephemeral=True)
+            return
+
+        # реакций может быть много — отвечаем позже, чтобы не упереться в 3 секунды
+        await interaction.response.defer(ephemeral=True)
+
+        channel = interaction.channel
+        lines = [title or "Выберите роли:"] + [f"{emoji} — {role.mention}" for emoji, role in menu]
+        message = await channel.send("\n".join(lines))
+
+        try:
+            for emoji, _ in menu:
+                await message.add_reaction(emoji)
+        except Exception as e:
+            await interaction.followup.send(f"❌ Не удалось добавить реакцию: {e}", ephemeral=True)
+            await message.delete()
+            return
+
+        try:
+            await save_role_reactions([(message.id, channel.id, emoji, role.id) for emoji, role in menu])
+        except Exception as e:
+            await interaction.followup.send(f"❌ Ошибка при сохранении в БД: {e}", ephemeral=True)
+            await message.delete()
+            return
+
+        await interaction.followup.send(f"✅ Меню создано! Ролей: {len(menu)}", ephemeral=True)
+
+    # ----------------------------
+    # SLASH: Role Menu (кнопки вместо реакций)
+    # ----------------------------
+    @bot.tree.command(name="role_menu", description="Создать меню ролей с кнопками")
+    @discord.app_commands.describe(
+        pairs="Пары эмодзи и роль через ; например: 🎮 @Игрок; 🎨 @Художник",
+        title="Заголовок сообщения"
+    )
+    async def role_menu(interaction: discord.Interaction, pairs: str, title: str | None = None):
+        """Создаёт сообщение с кнопками; нажатие выдаёт/снимает роль без reactions intent."""
+        
+        if interaction.guild is None:
+            await interaction.response.send_message("Эта команда работает только на сервере.", ephemeral=True)
+            return
+
+        if not interaction.user.guild_permissions.manage_roles:
+            await interaction.response.send_message("❌ У вас нет прав на управление ролями.", ephemeral=True)
+            return
+        
+        bot_member = interaction.guild.get_member(bot.user.id)
+        if not bot_member or not bot_member.guild_permissions.manage_roles:
+            await interaction.response.send_message("❌ У бота нет прав на управление ролями.", ephemeral=True)
+            return
+
+        menu, error = parse_role_menu(interaction.guild, bot_member, pairs)
+        if error:
+            await interaction.response.send_message(error, ephemeral=True)
+            return
+        if len(menu) > ROLE_MENU_MAX_BUTTONS:
+            await interaction.response.send_message(f"❌ Максимум {ROLE_MENU_MAX_BUTTONS} ролей в одном меню.", ephemeral=True)
+            return
+
+        lines = [title or "Выберите роли:"] + [f"{emoji} — {role.mention}" for emoji, role in menu]
+        try:
+            await interaction.channel.send("\n".join(lines), view=build_role_menu_view(menu))
+        except Exception as e:
+            await interaction.response.send_message(f"❌ Не удалось отправить меню: {e}", ephemeral=True)
+            return
+
+        await interaction.response.send_message(f"✅ Меню создано! Ролей: {len(menu)}", ephemeral=True)
+
+    # ----------------------------
+    # SLASH: /role_dm enabled
+    # ----------------------------
+    @bot.tree.command(name="role_dm", description="Включить/выключить личные сообщения о выдаче ролей")
+    async def role_dm(interaction: discord.Interaction, enabled: bool):
+        try:
+            await set_role_dm_enabled(interaction.user.id, enabled)
+        except Exception as e:
+            logger.error(e)
+            await interaction.response.send_message("Ошибка сохранения настройки! (см логи)", ephemeral=True)
+            return
+        if enabled:
+            await interaction.response.send_message("✅ Личные сообщения о ролях включены.", ephemeral=True)
+        else:
+            await interaction.response.send_message("🔕 Личные сообщения о ролях отключены.", ephemeral=True)
+
+    # ----------------------------
+    # SLASH: migrate_role_reactions (role_reaction -> кнопки)
+    # ----------------------------
+    @bot.tree.command(name="migrate_role_reactions", description="Перевести все role_reaction сообщения на кнопки [owner]")
+    async def migrate_role_reactions(interaction: discord.Interaction):
+        if not has_perm(interaction.user.id, PermRole.OWNER):
+            await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        rows_by_message: Dict[int, list] = {}
+        for row in sorted(_role_reactions.values()):
+            rows_by_message.setdefault(row[0], []).append(row)
+
+        migrated, failed = 0, 0
+        for message_id, rows in rows_by_message.items():
+            channel_id = rows[0][1]
+            try:
+                channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+                message = await channel.fetch_message(message_id)
+                if message.author.id != bot.user.id:
+                    failed += 1
+                    continue
+                menu = []
+                for _, _, emoji, role_id in rows[:ROLE_MENU_MAX_BUTTONS]:
+                    role = message.guild.get_role(role_id)
+                    if role is not None:
+                        menu.append((emoji, role))
+                if menu:
+                    await message.edit(view=build_role_menu_view(menu))
+                try:
+                    await message.clear_reactions()
+                except discord.Forbidden:
+                    pass  # без Manage Messages реакции останутся, но больше ничего не делают
+                await delete_role_reaction(message_id)
+                migrated += 1
+            except discord.NotFound:
+                # сообщение удалено — просто чистим записи
+                await delete_role_reaction(message_id)
+            except Exception as e:
+                logging.error(f"Не удалось перевести role_reaction {message_id} на кнопки: {e}")
+                failed += 1
+
+        await interaction.followup.send(
+            f"✅ Переведено меню: {migrated}, ошибок: {failed}. "
+            "Когда role_reaction не останется, можно выключить \"REACTION_ROLES\" в setings.json.",
+            ephemeral=True
+        )
+
     # ----------------------------
     # SLASH: set_new_member_channel
     # ----------------------------
@@ -1441,7 +3036,7 @@ def mainbotstart():
             return
         targetchanel = channel or interaction.channel
         try:
-            save_join_leave_channel(targetchanel.id)
+            await save_join_leave_channel(targetchanel.id)
             await interaction.response.send_message("Успешно!", ephemeral=True)
         except Exception as e:
             logger.error(e)
@@ -1450,109 +3045,102 @@ def mainbotstart():
     # ----------------------------
     # ОБРАБОТКА ОСТАЛЬНЫХ СООБЩЕНИЙ
     # ----------------------------      
-    async def on_sus_message(message):
-        if message.author.bot:
+    @bot.tree.command(name="reload_triggers", description="Перечитать правила авто-ответов из triggers.json (owner only).")
+    async def reload_triggers(interaction: discord.Interaction):
+        if not has_perm(interaction.user.id, PermRole.OWNER):
+            await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
             return
-        if "<@1409084528588488727>" in message.content.lower():
-            # reply автоматически упомянет автора (mention_author=True по умолчанию)
-            await message.reply(r"https://tenor.com/view/fuck-you-gif-27037587", mention_author=True, delete_after=10)
-
-        if "осуждаю" in message.content.lower():
-            await message.reply(r"https://tenor.com/view/%D1%81%D1%82%D0%B8%D0%BD%D1%82-%D1%81%D1%82%D0%B8%D0%BD%D1%82%D0%B8%D0%BA-stint-stintik-%D0%B8%D1%81%D0%BF%D1%83%D0%B3%D0%B0%D0%BB%D1%81%D1%8F-gif-8740975965519379714", mention_author=True, delete_after=15)
-
-        if r"||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​||||​" in message.content.lower():
-            await message.reply(r"https://tenor.com/view/ghost-ping-troll-discord-gif-20744771", mention_author=True)
-        
-        if "@everyone" in message.content.lower():
-            await message.reply(r"https://tenor.com/view/everyone-discord-konosuba-gif-21395141", mention_author=True, delete_after=15)
-        
-        if "@here" in message.content.lower():
-            await message.reply(r"https://tenor.com/view/everyone-discord-gif-18237159", mention_author=True, delete_after=15)
-        
-        if "да" == message.content.lower():
-            if random.randint(1, 50) == 1:
-                await message.reply(r"пизда", mention_author=True, delete_after=60)   
+        try:
+            count = triggers.reload()
+        except Exception as e:
+            await interaction.response.send_message(f"Ошибка в {TRIGGERS_FILE.name}, работают прежние правила: {e}", ephemeral=True)
+            return
+        await interaction.response.send_message(f"Правил авто-ответов загружено: **{count}**.", ephemeral=True)
 
-        if "нет" == message.content.lower():
-            if random.randint(1, 50) == 1:
-                await message.reply(r"пидора ответ", mention_author=True, delete_after=60)
-        
-        TENOR_RE = re.compile(r"https?://(?:www\.)?tenor\.com", re.IGNORECASE)
-        DS_RE = re.compile(r"https://media.discordapp.net/")
-        if TENOR_RE.search(message.content or "") or DS_RE.search(message.content or ""):
+    def sus_prefilter(message):
+        """Фильтр для диспетчера: (совпавшие правила, есть ли ссылка на гифку) или None."""
+        if message.author.bot:
+            return None
+        content = message.content or ""
+        # все авто-ответы — одним проходом по сообщению, правила в configs_folder/triggers.json
+        rules = triggers.match(content)
+        has_gif = GIF_LINK_RE.search(content) is not None
+        return (rules, has_gif) if rules or has_gif else None
+
+    async def on_sus_message(message, hint):
+        rules, has_gif = hint
+        for rule in rules:
+            if rule.fires() and reply_limiter.allow(rule.name, message.author.id, message.channel.id):
+                # reply автоматически упомянет автора (mention_author=True по умолчанию);
+                # если канал завален, из одинаковых ответов уходит только последний
+                outbound.submit(("channel", message.channel.id),
+                                lambda rule=rule: reply_expiring(message, rule.reply, rule.delete_after),
+                                SendPriority.LOW, coalesce_key=("auto_reply", message.channel.id, rule.name))
+
+        if has_gif:
             # получаем права автора именно в этом канале
             perms = message.channel.permissions_for(message.author)
             # attach_files — право прикреплять файлы/гифки      
-            if not perms.attach_files:
+            if not perms.attach_files and reply_limiter.allow("gif_perms", message.author.id, message.channel.id):
                 # проверяем, может ли бот писать в канал
                 bot_perms = message.channel.permissions_for(message.guild.me if message.guild else bot.user)
                 if not bot_perms.send_messages:
                     # если бот не может ответить в канале — попробуем в лс
-                    try:
-                        await message.author.send(
-                            "https://tenor.com/view/no-gif-no-gif-perms-gif-27679658"
-                        )
-                    except Exception:
-                        pass
+                    outbound.submit(("dm", message.author.id), lambda: message.author.send(
+                        "https://tenor.com/view/no-gif-no-gif-perms-gif-27679658"
+                    ), SendPriority.LOW)
                     return
 
                 # отвечаем реплаем (упомянет автора) и даём понятную подсказку
-                await message.reply(
+                outbound.submit(("channel", message.channel.id), lambda: message.reply(
                     "https://tenor.com/view/no-gif-no-gif-perms-gif-27679658",
                     mention_author=True
-                    )
+                    ), SendPriority.LOW)
                 
     # ----------------------------
     # Обработчики для выхода участника
     # ----------------------------
     @bot.event
     async def on_member_remove(member):
-        channel_id = get_join_leave_channel()
-        if channel_id == None:
-            return
-        
-        channel = member.guild.get_channel(channel_id)
-        if channel is None:
-            return
-
-        await channel.send(
-            f"Пользователь {member.mention} ({member.name}) id: `{member.id}` покинул сервер."
-        )
+        join_leave_announcer.announce("leave", member)
 
     # ----------------------------
     # Обработчики для входа участника
     # ----------------------------
     @bot.event
     async def on_member_join(member):
-        channel_id = get_join_leave_channel()
-        if channel_id == None:
-            return
-        
-        channel = member.guild.get_channel(channel_id)
-        if channel is None:
-            return
-
-        await channel.send(
-            f"Добро пожаловать, {member.mention}! ({member.name}, id: `{member.id}` )",
-        )
+        join_leave_announcer.announce("join", member)
     # ----------------------------
     # Обработчики для role_reactions
     # ----------------------------
     @bot.event
     async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
         """Обработчик удаления сообщения - удаляет role_reaction из БД."""
+        if not is_role_reaction_message(payload.message_id):
+            return  # обычное сообщение — в БД ничего нет
         try:
-            delete_role_reaction(payload.message_id)
+            await delete_role_reaction(payload.message_id)
         except Exception as e:
             logging.error(f"Ошибка при удалении role_reaction из БД: {e}")
 
+    @bot.event
+    async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+        """Массовое удаление сообщений (purge) — чистим role_reactions только для отслеживаемых."""
+        for message_id in payload.message_ids & _role_reaction_messages:
+            try:
+                await delete_role_reaction(message_id)
+            except Exception as e:
+                logging.error(f"Ошибка при удалении role_reaction из БД: {e}")
+
     @bot.event
     async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
         """Обработчик добавления реакции."""
+        if not is_role_reaction_message(payload.message_id):
+            return  # Не role_reaction сообщение
         if payload.user_id == bot.user.id:
             return  # Игнорируем реакции самого бота
         
-        # Получаем информацию о роле из БД
+        # Получаем информацию о роле из индекса
         emoji_str = str(payload.emoji)
         role_data = get_role_reaction(payload.message_id, emoji_str)
         
@@ -1574,30 +3162,26 @@ def mainbotstart():
             if not role:
                 return
             
-            # Проверяем, есть ли уже роль у пользователя
-            had_role = role in member.roles
+            # Выдаём через очередь гильдии: клики за короткое окно склеиваются в один запрос
+            had_role = await get_role_queue(guild.id).submit(member, role, add=True, reason=f"Role reaction на {emoji_str}")
+            if had_role is None:
+                return  # перекрыто более поздним снятием реакции
             
+            # Личное сообщение — только если роль реально выдана, и одно на серию изменений
             if not had_role:
-                await member.add_roles(role, reason=f"Role reaction на {emoji_str}")
-            
-            # Отправляем личное сообщение пользователю
-            try:
-                if had_role:
-                    await member.send(f"ℹ️ Вы уже имели роль **{role.name}**")
-                else:
-                    await member.send(f"✅ Вам была выдана роль **{role.name}**")
-            except Exception as e:
-                logging.warning(f"Не удалось отправить личное сообщение о выдаче роли: {e}")
+                role_notifier.notify(member, role, granted=True)
         except Exception as e:
             logging.error(f"Ошибка при добавлении роли на реакцию: {e}")
 
     @bot.event
     async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
         """Обработчик удаления реакции."""
+        if not is_role_reaction_message(payload.message_id):
+            return  # Не role_reaction сообщение
         if payload.user_id == bot.user.id:
             return  # Игнорируем реакции самого бота
         
-        # Получаем информацию о роле из БД
+        # Получаем информацию о роле из индекса
         emoji_str = str(payload.emoji)
         role_data = get_role_reaction(payload.message_id, emoji_str)
         
@@ -1619,28 +3203,74 @@ def mainbotstart():
             if not role:
                 return
             
-            # Проверяем, есть ли роль у пользователя
-            had_role = role in member.roles
+            # Снимаем через очередь гильдии: клики за короткое окно склеиваются в один запрос
+            had_role = await get_role_queue(guild.id).submit(member, role, add=False, reason=f"Удалена реакция на {emoji_str}")
+            if had_role is None:
+                return  # перекрыто более поздней реакцией
             
+            # Личное сообщение — только если роль реально снята, и одно на серию изменений
             if had_role:
-                await member.remove_roles(role, reason=f"Удалена реакция на {emoji_str}")
-            
-            # Отправляем личное сообщение пользователю
-            try:
-                if had_role:
-                    await member.send(f"✅ Вам была забрана роль **{role.name}**")
-                else:
-                    await member.send(f"ℹ️ Вы не имели роль **{role.name}**")
-            except Exception as e:
-                logging.warning(f"Не удалось отправить личное сообщение об удалении роли: {e}")
+                role_notifier.notify(member, role, granted=False)
         except Exception as e:
             logging.error(f"Ошибка при удалении роли на реакцию: {e}")
 
+    # --- Диспетчер сообщений ---
+    message_dispatcher.register("commands", _command_prefilter, lambda message, _: bot.process_commands(message), timeout=120)
+    message_dispatcher.register("counting", lambda message: message.channel.id in _counters, on_counting_message, timeout=5)
+    message_dispatcher.register("auto_reply", sus_prefilter, on_sus_message, timeout=30)
+
+    @bot.tree.command(name="reply_limits", description="Бюджеты и отброшенные ответы бота (owner only).")
+    async def reply_limits(interaction: discord.Interaction):
+        if not has_perm(interaction.user.id, PermRole.OWNER):
+            await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
+            return
+
+        lines = ["**Ограничение ответов бота**"]
+        for scope, (capacity, period) in reply_limiter.periods.items():
+            lines.append(f"{scope}: {capacity:g} за {period:g} с — отброшено **{reply_limiter.dropped_by_scope[scope]}**")
+        lines.append(f"Отправлено: **{reply_limiter.allowed}**, активных бакетов: {len(reply_limiter)}")
+        if reply_limiter.dropped_by_trigger:
+            by_trigger = sorted(reply_limiter.dropped_by_trigger.items(), key=lambda item: item[1], reverse=True)
+            lines.append("По триггерам: " + ", ".join(f"{name} — {count}" for name, count in by_trigger))
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+    @bot.tree.command(name="dispatch_stats", description="Задержки обработчиков сообщений (owner only).")
+    async def dispatch_stats(interaction: discord.Interaction):
+        if not has_perm(interaction.user.id, PermRole.OWNER):
+            await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
+            return
+
+        lines = ["**Обработчики сообщений**", "```", f"{'имя':<12}{'вызовов':>9}{'пропущено':>11}{'p50 мс':>9}{'p95 мс':>9}{'max мс':>9}{'ошибок':>8}{'таймаутов':>11}"]
+        for entry in message_dispatcher.handlers:
+            lines.append(
+                f"{entry.name:<12}{entry.calls:>9}{entry.skipped:>11}"
+                f"{entry.percentile(0.5) * 1000:>9.1f}{entry.percentile(0.95) * 1000:>9.1f}{entry.max_time * 1000:>9.1f}"
+                f"{entry.errors:>8}{entry.timeouts:>11}"
+            )
+        lines.append("```")
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+    @bot.tree.command(name="outbound_stats", description="Очередь исходящих сообщений бота (owner only).")
+    async def outbound_stats(interaction: discord.Interaction):
+        if not has_perm(interaction.user.id, PermRole.OWNER):
+            await interaction.response.send_message("У вас нет прав для этой команды.", ephemeral=True)
+            return
+
+        lines = ["**Исходящие сообщения**", "```", f"{'приоритет':<10}{'в очереди':>11}{'отправлено':>12}{'p50 мс':>9}{'p95 мс':>9}{'устарело':>10}{'схлопнуто':>11}{'ошибок':>8}"]
+        for priority, stats in outbound.stats.items():
+            lines.append(
+                f"{priority.name.lower():<10}{stats.depth:>11}{stats.sent:>12}"
+                f"{_percentile(stats.waits, 0.5) * 1000:>9.0f}{_percentile(stats.waits, 0.95) * 1000:>9.0f}"
+                f"{stats.stale:>10}{stats.coalesced:>11}{stats.failed:>8}"
+            )
+        lines.append("```")
+        lines.append(f"Маршрутов под 429: **{outbound.blocked_routes()}**")
+        lines.append(f"Ожидают удаления: **{deletions.pending()}**, обработано: **{deletions.processed}** (массовых запросов: {deletions.bulk_requests})")
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
     @bot.event
     async def on_message(message: discord.Message):
-        await bot.process_commands(message)
-        await on_counting_message(message)
-        await on_sus_message(message)
+        await message_dispatcher.dispatch(message)
     
 
         
@@ -1652,6 +3282,11 @@ def mainbotstart():
     @bot.event
     async def on_ready():
         
+        start_background_tasks()
+
+        if _counting_catchup_pending:
+            spawn(catch_up_counters())
+
         try:
             await notify_after_restart()
         except Exception as e:
@@ -1666,6 +3301,9 @@ def mainbotstart():
 
         logging.info(f"✅ Ready: {bot.user}")
 
+    # кнопки всех /role_menu (custom_id role_menu:<id>) — одна регистрация на все сообщения
+    bot.add_dynamic_items(RoleMenuButton)
+
     bot.run(DISCORD_TOKEN)
 
 
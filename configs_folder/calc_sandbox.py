@@ -0,0 +1,156 @@
+"""
+Песочница для тяжёлых выражений /calculate.
+
+Выражения, которые калькулятор оценил как тяжёлые (огромные степени, факториалы, сдвиги),
+считаются не в процессе бота, а в пуле отдельных процессов-воркеров:
+- у каждого воркера ограничена память (RLIMIT_AS, где он есть);
+- на каждое выражение есть жёсткий таймаут — зависший воркер убивается и заменяется новым;
+- огромные числа переводятся в текст тоже в воркере, event loop бота их не форматирует.
+
+Воркеры запускаются как `python -m configs_folder.calc_sandbox` и общаются с ботом
+строками JSON через stdin/stdout, поэтому в них не импортируется bot.py.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+from configs_folder.calculator import CalcError, compile_expression, format_result
+
+CALC_WORKERS = 2                        # сколько процессов-воркеров держать
+CALC_TIMEOUT = 10.0                     # сек на одно выражение, включая перевод в текст
+CALC_MEMORY_LIMIT = 512 * 1024 * 1024   # байт адресного пространства на воркер
+_STREAM_LIMIT = 16 * 1024 * 1024        # максимальная длина строки ответа воркера
+
+_ROOT = Path(__file__).parent.parent
+
+
+class _Worker:
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.killed = False
+
+    @property
+    def alive(self) -> bool:
+        # returncode появляется только после того, как процесс подобран, поэтому и флаг
+        return not self.killed and self.proc.returncode is None
+
+    async def evaluate(self, expr: str) -> dict:
+        self.proc.stdin.write(json.dumps({"expr": expr}).encode() + b"\n")
+        await self.proc.stdin.drain()
+        line = await self.proc.stdout.readline()
+        if not line:
+            raise CalcError("Вычисление прервано: превышен лимит памяти.")
+        return json.loads(line)
+
+    def kill(self) -> None:
+        if self.alive:
+            self.killed = True
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass  # уже завершился сам
+
+
+class CalcSandbox:
+    """Пул процессов-воркеров. Воркеры поднимаются лениво, при первом тяжёлом выражении."""
+
+    def __init__(self, size: int = CALC_WORKERS, timeout: float = CALC_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.timeouts = 0
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers: List[_Worker] = []
+
+    async def _spawn(self) -> _Worker:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "configs_folder.calc_sandbox",
+            cwd=str(_ROOT),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=_STREAM_LIMIT,
+        )
+        worker = _Worker(proc)
+        self._workers.append(worker)
+        return worker
+
+    async def _acquire(self) -> _Worker:
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                self._idle.put_nowait(None)  # None — место под воркер, который ещё не запущен
+        worker = await self._idle.get()
+        if worker is None or not worker.alive:
+            if worker is not None:
+                self._workers.remove(worker)
+            try:
+                worker = await self._spawn()
+            except Exception:
+                self._idle.put_nowait(None)
+                raise
+        return worker
+
+    async def evaluate(self, expr: str) -> tuple:
+        """Вычислить выражение в воркере. Возвращает (текст результата, число ли это). Ошибки — CalcError."""
+        worker = await self._acquire()
+        try:
+            reply = await asyncio.wait_for(worker.evaluate(expr), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            worker.kill()
+            raise CalcError(f"Вычисление заняло больше {self.timeout:g} с и было остановлено.")
+        except BaseException:
+            worker.kill()  # состояние канала неизвестно — воркер больше не используем
+            raise
+        finally:
+            self._idle.put_nowait(worker)
+
+        if not reply.get("ok"):
+            raise CalcError(reply.get("error") or "Ошибка при вычислении.")
+        return reply["text"], reply["number"]
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.kill()
+        self._workers.clear()
+
+
+def _limit_memory() -> None:
+    try:
+        import resource
+    except ImportError:
+        return  # Windows: ограничение только по времени
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (CALC_MEMORY_LIMIT, CALC_MEMORY_LIMIT))
+    except (ValueError, OSError) as e:
+        logging.warning(f"Не удалось ограничить память воркера калькулятора: {e}")
+
+
+def _evaluate_request(expr: str) -> dict:
+    try:
+        fn, _ = compile_expression(expr)
+        value = fn()
+        return {"ok": True, "text": format_result(value), "number": isinstance(value, (int, float, complex))}
+    except CalcError as e:
+        return {"ok": False, "error": str(e)}
+    except MemoryError:
+        return {"ok": False, "error": "Вычисление прервано: превышен лимит памяти."}
+    except Exception as e:
+        return {"ok": False, "error": f"Ошибка при вычислении: {e}"}
+
+
+def _worker_main() -> None:
+    _limit_memory()
+    if hasattr(sys, "set_int_max_str_digits"):
+        sys.set_int_max_str_digits(0)  # огромные int переводим в текст здесь, а не в боте
+    for line in sys.stdin:
+        request = json.loads(line)
+        sys.stdout.write(json.dumps(_evaluate_request(request["expr"])) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    _worker_main()
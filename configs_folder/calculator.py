@@ -0,0 +1,645 @@
+"""
+Калькулятор выражений для /calculate и counting канала.
+
+Выражение разбирается ast.parse и за один проход по дереву компилируется в цепочку замыканий:
+каждая операция берётся из таблиц _BIN_OPS/_UNARY_OPS, имена сразу заменяются на значения из
+_SAFE_NAMES, а недопустимые узлы и неизвестные идентификаторы отсекаются на том же проходе.
+Вычисление — это просто вызов замыкания, без isinstance-проверок на каждом узле.
+
+Скомпилированные выражения (и их результаты — все разрешённые функции чистые) лежат
+в LRU кэше calc_cache по исходной строке.
+
+При компиляции оценивается, сколько бит займёт самое большое промежуточное число
+(9**9**9, factorial(10**6), 1<<10**9 и т.п.):
+- до CALC_INLINE_MAX_BITS — выражение дешёвое, считается прямо в процессе бота;
+- до CALC_MAX_RESULT_BITS — тяжёлое, считается в песочнице (configs_folder/calc_sandbox.py);
+- больше — отклоняется сразу, с оценкой числа цифр.
+
+Режим диапазона ("sin(x)^2 for x in 0..10 step 0.01", calc_range): тело компилируется один раз
+с переменной, и если установлен numpy — вычисляется сразу над массивом всех точек
+(функции берутся из numpy), иначе то же замыкание вызывается поточечно.
+График рисуется через matplotlib, если он установлен.
+"""
+
+import ast
+import io
+import math
+import operator
+import re
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # numpy есть в requirements.txt, но без него диапазон всё равно считается (поточечно)
+    np = None
+
+_PREPROCESS_REPLACES = {
+    '^': '**',
+    'tg(': 'tan(',
+    'ctg(': '1/tan(',
+    'ln(': 'log('
+}
+
+_SAFE_NAMES = {
+    'pi': math.pi,
+    'e': math.e,
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'asin': math.asin,
+    'acos': math.acos,
+    'atan': math.atan,
+    'sinh': math.sinh,
+    'cosh': math.cosh,
+    'tanh': math.tanh,
+    'sqrt': math.sqrt,
+    'log': math.log,
+    'log10': math.log10,
+    'log2': math.log2,
+    'abs': abs,
+    'floor': math.floor,
+    'ceil': math.ceil,
+    'round': round,
+    'factorial': math.factorial,
+    'pow': pow,
+}
+
+_BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitXor: operator.xor,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+}
+
+_UNARY_OPS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+CALC_INLINE_MAX_BITS = 14000         # до скольких бит считаем прямо в процессе бота (~4200 цифр, меньше лимита int->str в 4300)
+CALC_MAX_RESULT_BITS = 1 << 20       # больше (~315 тыс. цифр) — не считаем вообще
+
+CALC_CACHE_SIZE = 1024                # сколько разных выражений помнить
+CALC_CACHE_RESULT_MAX_BYTES = 4096    # результаты крупнее не кэшируем (огромные int и т.п.)
+
+
+class CalcError(Exception):
+    """Выражение нельзя вычислить; текст исключения уже готов для пользователя."""
+
+
+def _preprocess(expr: str) -> str:
+    s = expr
+    for k, v in _PREPROCESS_REPLACES.items():
+        s = s.replace(k, v)
+    return s
+
+
+def _disallowed(node: ast.AST) -> CalcError:
+    return CalcError(f"Недопустимый элемент в выражении: {type(node).__name__}")
+
+
+def _compile_node(node: ast.AST, unknown: set, names: dict = _SAFE_NAMES, cells: Optional[dict] = None) -> Callable[[], Any]:
+    """
+    Превращает узел в замыкание без аргументов. Неизвестные имена собираются в unknown.
+    names — таблица функций и констант, cells — переменные (имя -> список из одного значения),
+    которые читаются в момент вызова замыкания.
+    """
+    kind = type(node)
+
+    if kind is ast.Constant:
+        value = node.value
+        return lambda: value
+
+    if kind is ast.BinOp:
+        op = _BIN_OPS.get(type(node.op))
+        if op is None:
+            raise _disallowed(node.op)
+        left = _compile_node(node.left, unknown, names, cells)
+        right = _compile_node(node.right, unknown, names, cells)
+        return lambda: op(left(), right())
+
+    if kind is ast.UnaryOp:
+        op = _UNARY_OPS.get(type(node.op))
+        if op is None:
+            raise _disallowed(node.op)
+        operand = _compile_node(node.operand, unknown, names, cells)
+        return lambda: op(operand())
+
+    if kind is ast.Name:
+        if cells and node.id in cells:
+            cell = cells[node.id]
+            return lambda: cell[0]
+        if node.id not in names:
+            unknown.add(node.id)
+            return _unresolved
+        value = names[node.id]
+        return lambda: value
+
+    if kind is ast.Call:
+        if node.keywords:
+            raise _disallowed(node.keywords[0])
+        if type(node.func) is not ast.Name:
+            raise _disallowed(node.func)
+        fn = names.get(node.func.id, _unresolved)
+        if fn is _unresolved:
+            unknown.add(node.func.id)
+        args = [_compile_node(a, unknown, names, cells) for a in node.args]
+        if len(args) == 1:
+            arg, = args
+            return lambda: fn(arg())
+        if len(args) == 2:
+            first, second = args
+            return lambda: fn(first(), second())
+        return lambda: fn(*[a() for a in args])
+
+    raise _disallowed(node)
+
+
+# функции, которые всегда возвращают float (или падают) — их результат не растёт
+_FLOAT_FUNCS = {'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh', 'sqrt', 'log', 'log10', 'log2'}
+_FLOAT_BITS = 1024  # int из float (floor/round) не больше 2**1024
+
+
+def _pow_bits(base_bits: float, exp_bits: float) -> float:
+    # |a| <= 2**base_bits, b <= 2**exp_bits  =>  |a**b| <= 2**(base_bits * 2**exp_bits)
+    if base_bits <= 0:
+        return 0.0  # 0, 1, -1 в любой степени
+    if exp_bits > 64:
+        return math.inf
+    return base_bits * 2.0 ** exp_bits
+
+
+def _estimate(node: ast.AST, peak: list, variables: Optional[dict] = None) -> tuple:
+    """
+    Оценка сверху размера значения узла: (вид, бит). Вид — 'int', 'float', 'str' или 'other'.
+    Для int бит — log2 модуля, для str — 8*длина, для float — log2 модуля, если он известен, иначе 0.
+    variables — переменные с известной границей модуля (имя -> (вид, бит)).
+    peak[0] — максимум по всем промежуточным значениям.
+    Дерево уже проверено _compile_node, поэтому здесь встречаются только разрешённые узлы.
+    """
+    kind = type(node)
+    if kind is ast.Constant:
+        value = node.value
+        if isinstance(value, int):
+            result = ('int', math.log2(abs(value)) if value else 0.0)
+        elif isinstance(value, (str, bytes)):
+            result = ('str', 8.0 * len(value))
+        else:
+            result = ('float', 0.0)
+    elif kind is ast.Name:
+        if variables and node.id in variables:
+            result = variables[node.id]
+        else:
+            result = ('float', 0.0) if node.id in ('pi', 'e') else ('other', 0.0)
+    elif kind is ast.UnaryOp:
+        result = _estimate(node.operand, peak, variables)
+    elif kind is ast.BinOp:
+        left, right = _estimate(node.left, peak, variables), _estimate(node.right, peak, variables)
+        if type(node.op) is ast.Mod and left[0] == 'str':
+            result = ('str', left[1] + right[1] + _format_bits(node.left))
+        else:
+            result = _estimate_binop(type(node.op), left, right)
+    else:  # ast.Call
+        args = [_estimate(a, peak, variables) for a in node.args]
+        result = _estimate_call(node.func.id, args)
+    peak[0] = max(peak[0], result[1])
+    return result
+
+
+# ширина и точность в %-форматировании: '%0100000000d' % 1 — строка на 100 МБ
+_FORMAT_SPEC_RE = re.compile(rb'%(?:\([^)]*\))?[-+ #0]*(\*|\d*)(?:\.(\*|\d*))?')
+
+
+def _format_bits(node: ast.AST) -> float:
+    """Сколько бит может добавить %-форматирование строкой node. Не константа — не оцениваем."""
+    if type(node) is not ast.Constant or not isinstance(node.value, (str, bytes)):
+        return math.inf  # формат собран из кусков ('%0' + '9'*9 + 'd') — ширину заранее не узнать
+    fmt = node.value.encode() if isinstance(node.value, str) else node.value
+    bits = 0.0
+    for width, precision in _FORMAT_SPEC_RE.findall(fmt):
+        if width == b'*' or precision == b'*':
+            return math.inf
+        bits += 8.0 * (int(width or 0) + int(precision or 0))
+    return bits
+
+
+def _estimate_binop(op: type, left: tuple, right: tuple) -> tuple:
+    (lkind, lbits), (rkind, rbits) = left, right
+    if lkind == 'str' or rkind == 'str':
+        if op is ast.Mult:
+            # строка * число: размер растёт в число раз
+            size, times = (lbits, rbits) if lkind == 'str' else (rbits, lbits)
+            return ('str', size * 2.0 ** times if times <= 64 else math.inf)
+        return ('str', lbits + rbits)
+    if lkind != 'int' or rkind != 'int':
+        return ('float', 0.0)
+    if op is ast.Pow:
+        return ('int', _pow_bits(lbits, rbits))
+    if op is ast.LShift:
+        return ('int', lbits + 2.0 ** rbits if rbits <= 64 else math.inf)
+    if op is ast.Mult:
+        return ('int', lbits + rbits)
+    if op in (ast.Add, ast.Sub, ast.BitOr, ast.BitXor):
+        return ('int', max(lbits, rbits) + 1)
+    if op is ast.Div:
+        return ('float', 0.0)
+    if op is ast.Mod or op is ast.BitAnd:
+        return ('int', min(lbits, rbits) if op is ast.BitAnd else rbits)
+    return ('int', lbits)  # FloorDiv, RShift
+
+
+def _estimate_call(name: str, args: list) -> tuple:
+    if name in _FLOAT_FUNCS:
+        return ('float', 0.0)
+    if not args:
+        return ('other', 0.0)
+    kind, bits = args[0]
+    if name == 'factorial':
+        if kind != 'int':
+            return ('other', 0.0)
+        if bits > 64:
+            return ('int', math.inf)
+        # формула Стирлинга: n! <= e * sqrt(n) * (n/e)**n
+        n = 2.0 ** bits
+        return ('int', max(0.0, math.log2(math.e) + (n + 0.5) * bits - n * math.log2(math.e)))
+    if name == 'pow':
+        if len(args) == 3:
+            return ('int', args[2][1])  # по модулю — не больше модуля
+        if len(args) == 2:
+            return _estimate_binop(ast.Pow, args[0], args[1])
+    if name == 'round' and len(args) == 2 and args[1][0] == 'int':
+        # round(x, -n) внутри считает 10**n — оцениваем как 10**|n| (знак n здесь не известен)
+        ndigits_bits = args[1][1]
+        scale = 2.0 ** ndigits_bits * math.log2(10) if ndigits_bits <= 64 else math.inf
+        return (kind, max(bits, scale))
+    if name in ('floor', 'ceil', 'round') and kind == 'float' and len(args) == 1:
+        return ('int', bits or float(_FLOAT_BITS))
+    return (kind, bits)  # abs, round(x, n), floor/ceil от int
+
+
+def _unresolved() -> Any:
+    # до вызова не доходит: compile_expression отклоняет выражения с неизвестными именами
+    raise CalcError("Неизвестный идентификатор")
+
+
+def compile_expression(expr: str) -> tuple:
+    """
+    Препроцессинг, разбор, проверка и компиляция выражения.
+    Возвращает (замыкание, оценка в битах самого большого промежуточного значения). Ошибки — CalcError.
+    """
+    tree = _parse(expr)
+    unknown: set = set()
+    fn = _compile_node(tree.body, unknown)
+    _check_unknown(unknown)
+    cost = _estimate_cost(tree.body)
+    if cost > CALC_MAX_RESULT_BITS:
+        raise _too_large(cost)
+    return fn, cost
+
+
+def _parse(expr: str) -> ast.Expression:
+    try:
+        return ast.parse(_preprocess(expr), mode='eval')
+    except Exception as e:
+        raise CalcError(f"Синтаксическая ошибка: {e}")
+
+
+def _check_unknown(unknown: set) -> None:
+    if unknown:
+        raise CalcError(f"Неизвестные идентификаторы: {', '.join(sorted(unknown))}")
+
+
+def _estimate_cost(body: ast.AST, variables: Optional[dict] = None) -> float:
+    peak = [0.0]
+    _estimate(body, peak, variables)
+    return peak[0]
+
+
+def _too_large(cost: float) -> CalcError:
+    if math.isinf(cost):
+        return CalcError("Результат слишком большой, чтобы его вычислять.")
+    return CalcError(f"Результат слишком большой: около {cost * math.log10(2):.3g} цифр.")
+
+
+def format_result(value: Any) -> str:
+    """Текст результата; огромные int форматируются долго — для них вызывать вне event loop."""
+    if isinstance(value, float):
+        return f"{value:.12g}"
+    return str(value)
+
+
+_NO_RESULT = object()
+
+
+class _CachedExpression:
+    __slots__ = ("fn", "cost", "result", "error")
+
+    def __init__(self, fn: Optional[Callable[[], Any]] = None, cost: float = 0.0, error: Optional[CalcError] = None):
+        self.fn = fn
+        self.cost = cost
+        self.result = _NO_RESULT
+        self.error = error
+
+    @property
+    def heavy(self) -> bool:
+        """Слишком дорого для event loop — считать в песочнице."""
+        return self.cost > CALC_INLINE_MAX_BITS
+
+
+class ExpressionCache:
+    """
+    LRU кэш скомпилированных выражений по исходной строке.
+    Хранит замыкание, а так как все разрешённые функции чистые — и готовый результат
+    (или ошибку), так что повторное выражение не парсится и не вычисляется заново.
+    Используется и из event loop, и из executor (counting), поэтому под замком.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, _CachedExpression]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[_CachedExpression]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: _CachedExpression) -> None:
+        with self._lock:
+            self._items[key] = entry
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+calc_cache = ExpressionCache(CALC_CACHE_SIZE)
+
+
+def calc_prepare(expr: str) -> _CachedExpression:
+    """Скомпилировать выражение (через кэш), не вычисляя. Ошибки компиляции и оценки — CalcError."""
+    entry = calc_cache.get(expr)
+    if entry is None:
+        try:
+            entry = _CachedExpression(*compile_expression(expr))
+        except CalcError as e:
+            entry = _CachedExpression(error=e)
+        calc_cache.put(expr, entry)
+
+    if entry.error is not None:
+        raise entry.error
+    return entry
+
+
+def calc_evaluate(expr: str) -> Any:
+    """Вычислить дешёвое выражение через кэш. Ошибки (в том числе тяжёлое выражение) — CalcError."""
+    entry = calc_prepare(expr)
+    if entry.heavy:
+        raise CalcError("Выражение слишком тяжёлое для быстрого вычисления.")
+    if entry.result is not _NO_RESULT:
+        return entry.result
+
+    try:
+        result = entry.fn()
+    except Exception as e:
+        entry.error = CalcError(f"Ошибка при вычислении: {e}")
+        raise entry.error
+    if sys.getsizeof(result) <= CALC_CACHE_RESULT_MAX_BYTES:
+        entry.result = result
+    return result
+
+
+# ------------------ Режим диапазона ------------------
+
+CALC_RANGE_MAX_POINTS = 1000001            # больше точек за один запрос не считаем (numpy)
+CALC_RANGE_POINTWISE_MAX_POINTS = 10001    # без numpy каждая точка — вызов замыкания, поэтому меньше
+CALC_RANGE_CSV_MAX_ROWS = 100001           # CSV крупнее прореживается, чтобы файл влез в лимит вложений Discord
+CALC_RANGE_DEFAULT_POINTS = 101   # если step не указан
+
+_RANGE_RE = re.compile(
+    r"^(?P<body>.+?)\s+for\s+(?P<var>[A-Za-z_]\w*)\s+in\s+(?P<start>.+?)\.\.(?P<stop>.+?)(?:\s+step\s+(?P<step>.+))?$",
+    re.S,
+)
+
+
+def _numpy_names() -> dict:
+    """Та же таблица, что _SAFE_NAMES, но функции работают над массивами."""
+    def log(x, base=None):
+        return np.log(x) if base is None else np.log(x) / np.log(base)
+
+    def round_(x, ndigits=0):
+        return np.round(x, int(ndigits))
+
+    def factorial_one(v):
+        return float(math.factorial(int(v))) if v >= 0 and v == int(v) else math.nan
+
+    factorial = np.vectorize(factorial_one, otypes=[float])
+
+    return {
+        'pi': math.pi,
+        'e': math.e,
+        'sin': np.sin,
+        'cos': np.cos,
+        'tan': np.tan,
+        'asin': np.arcsin,
+        'acos': np.arccos,
+        'atan': np.arctan,
+        'sinh': np.sinh,
+        'cosh': np.cosh,
+        'tanh': np.tanh,
+        'sqrt': np.sqrt,
+        'log': log,
+        'log10': np.log10,
+        'log2': np.log2,
+        'abs': np.abs,
+        'floor': np.floor,
+        'ceil': np.ceil,
+        'round': round_,
+        'factorial': factorial,
+        'pow': np.float_power,
+    }
+
+
+_NUMPY_NAMES = _numpy_names() if np is not None else None
+
+
+class RangeResult:
+    """
+    Значения выражения на диапазоне: ys[i] — значение в xs[i], nan — ошибка в точке.
+    При вычислении через numpy xs и ys — массивы numpy, иначе списки.
+    """
+
+    __slots__ = ("var", "xs", "ys", "vectorized")
+
+    def __init__(self, var: str, xs: List[float], ys: List[float], vectorized: bool):
+        self.var = var
+        self.xs = xs
+        self.ys = ys
+        self.vectorized = vectorized
+
+    def stats(self) -> dict:
+        if self.vectorized:
+            return self._stats_numpy()
+        points = [(x, y) for x, y in zip(self.xs, self.ys) if math.isfinite(y)]
+        result = {"count": len(self.xs), "errors": len(self.xs) - len(points)}
+        if points:
+            result["min"] = min(points, key=lambda p: p[1])
+            result["max"] = max(points, key=lambda p: p[1])
+            result["mean"] = math.fsum(y for _, y in points) / len(points)
+        return result
+
+    def _stats_numpy(self) -> dict:
+        finite = np.isfinite(self.ys)
+        count = int(finite.sum())
+        result = {"count": len(self.xs), "errors": len(self.xs) - count}
+        if count:
+            lo = int(np.argmin(np.where(finite, self.ys, np.inf)))
+            hi = int(np.argmax(np.where(finite, self.ys, -np.inf)))
+            result["min"] = (float(self.xs[lo]), float(self.ys[lo]))
+            result["max"] = (float(self.xs[hi]), float(self.ys[hi]))
+            result["mean"] = float(self.ys[finite].mean())
+        return result
+
+    def csv_stride(self, max_rows: int = CALC_RANGE_CSV_MAX_ROWS) -> int:
+        """В CSV попадает каждая csv_stride-я точка."""
+        return max(1, -(-len(self.xs) // max_rows))
+
+    def to_csv(self, max_rows: int = CALC_RANGE_CSV_MAX_ROWS) -> str:
+        stride = self.csv_stride(max_rows)
+        lines = [f"{self.var},value"]
+        lines.extend(f"{x:.12g},{y:.12g}" for x, y in zip(self.xs[::stride], self.ys[::stride]))
+        return "\n".join(lines) + "\n"
+
+
+def parse_range(expr: str) -> Optional[tuple]:
+    """(тело, переменная, начало, конец, шаг или None), если выражение — диапазон, иначе None."""
+    m = _RANGE_RE.match(expr.strip())
+    if m is None:
+        return None
+    return m.group('body', 'var', 'start', 'stop', 'step')
+
+
+def _range_bound(text: str) -> Any:
+    """Граница или шаг диапазона: int остаётся int (для битовых операций и factorial), иначе float."""
+    value = calc_evaluate(text.strip())
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise CalcError(f"Граница диапазона должна быть числом: {text.strip()}")
+    try:
+        finite = math.isfinite(float(value))
+    except OverflowError:
+        finite = False
+    if not finite:
+        raise CalcError(f"Граница диапазона должна быть конечной: {text.strip()}")
+    return value
+
+
+def _eval_pointwise(fn: Callable[[], Any], cell: list, xs: List[float]) -> List[float]:
+    ys = []
+    for x in xs:
+        cell[0] = x
+        try:
+            y = float(fn())
+        except Exception:
+            y = math.nan  # вне области определения, complex и т.п.
+        ys.append(y)
+    return ys
+
+
+def _eval_vectorized(body: ast.AST, var: str, xs: "np.ndarray") -> Optional["np.ndarray"]:
+    cell = [xs]
+    fn = _compile_node(body, set(), _NUMPY_NAMES, {var: cell})
+    try:
+        with np.errstate(all='ignore'):
+            return np.broadcast_to(np.asarray(fn(), dtype=float), xs.shape)
+    except Exception:
+        return None  # например, битовые операции над float — посчитаем поточечно
+
+
+def calc_range(expr: str) -> RangeResult:
+    """Вычислить выражение вида "<тело> for x in a..b [step h]". Ошибки — CalcError."""
+    parts = parse_range(expr)
+    if parts is None:
+        raise CalcError("Ожидается диапазон вида: sin(x)^2 for x in 0..10 step 0.01")
+    body, var, start_text, stop_text, step_text = parts
+
+    start, stop = _range_bound(start_text), _range_bound(stop_text)
+    if step_text is None:
+        step = (stop - start) / (CALC_RANGE_DEFAULT_POINTS - 1) or 1.0
+    else:
+        step = _range_bound(step_text)
+    if step == 0 or (stop - start) / step < 0:
+        raise CalcError("Шаг не ведёт от начала диапазона к концу.")
+    integral = isinstance(start, int) and isinstance(step, int)
+    if integral:
+        count = (stop - start) // step + 1 if isinstance(stop, int) else int(math.floor((stop - start) / step)) + 1
+    else:
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    if count > CALC_RANGE_MAX_POINTS:
+        raise CalcError(f"Слишком много точек: {count} (максимум {CALC_RANGE_MAX_POINTS}).")
+
+    tree = _parse(body)
+    cell = [0.0]
+    unknown: set = set()
+    fn = _compile_node(tree.body, unknown, cells={var: cell})
+    _check_unknown(unknown)
+    # каждая точка считается в процессе бота, поэтому и порог — как для обычного выражения
+    bound_bits = math.log2(max(abs(start), abs(stop), 1))
+    cost = _estimate_cost(tree.body, {var: ('int' if integral else 'float', bound_bits)})
+    if cost > CALC_INLINE_MAX_BITS:
+        raise CalcError("Выражение слишком тяжёлое, чтобы считать его на диапазоне.")
+
+    if np is not None:
+        xs = start + np.arange(count, dtype=float) * step  # float: int64 молча переполняется
+        ys = _eval_vectorized(tree.body, var, xs)
+        if ys is not None:
+            return RangeResult(var, xs, ys, vectorized=True)
+    if count > CALC_RANGE_POINTWISE_MAX_POINTS:
+        reason = "numpy не установлен" if np is None else "выражение не считается над массивом"
+        raise CalcError(
+            f"Слишком много точек: {count} ({reason}, поточечно — максимум {CALC_RANGE_POINTWISE_MAX_POINTS})."
+        )
+    # целые начало и шаг дают целые точки — для них работают &, |, <<, factorial
+    xs = [start + i * step for i in range(count)]
+    return RangeResult(var, xs, _eval_pointwise(fn, cell, xs), vectorized=False)
+
+
+def render_range_plot(result: RangeResult, title: str) -> Optional[bytes]:
+    """PNG с графиком или None, если matplotlib не установлен."""
+    try:
+        from matplotlib.figure import Figure
+    except ImportError:
+        return None
+    fig = Figure(figsize=(8, 4.5), dpi=100)
+    ax = fig.subplots()
+    ax.plot(result.xs, result.ys, linewidth=1.2)  # nan (ошибки) дают разрывы линии
+    ax.set_xlabel(result.var)
+    ax.set_title(title)
+    ax.grid(alpha=0.3)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    return buf.getvalue()
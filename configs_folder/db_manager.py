@@ -0,0 +1,231 @@
+"""
+Доступ к базе состояния бота bot_state.db.
+
+Раньше каждая функция в bot.py делала connect -> запрос -> commit -> close.
+Теперь на процесс открыто одно долгоживущее соединение:
+- journal_mode=WAL — читатели не блокируют писателя, commit не переписывает весь журнал;
+- synchronous=NORMAL — fsync только на checkpoint, а не на каждый commit (в WAL это безопасно
+  для целостности, при падении питания теряются максимум последние транзакции);
+- кэш подготовленных запросов sqlite3 (cached_statements) — повторяющиеся запросы не компилируются заново.
+
+Из корутин база используется только через adb (AsyncDatabase): запросы уходят в очередь
+отдельного потока, так что fsync/блокировки SQLite не останавливают event loop и heartbeat,
+а мелкие записи, накопившиеся в очереди, выполняются одной транзакцией.
+"""
+
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+# Файл базы рядом с bot.py
+DB_PATH = Path(__file__).parent.parent / "bot_state.db"
+
+# Сколько скомпилированных запросов держать в кэше соединения
+DB_CACHED_STATEMENTS = 256
+
+# Сколько ждать (мс), если база занята другим процессом
+DB_BUSY_TIMEOUT_MS = 5000
+
+# Сколько запросов из очереди максимум объединять в одну транзакцию
+DB_BATCH_MAX = 64
+
+
+class Database:
+    """Одно общее соединение с SQLite, открывается при первом обращении."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            with self.lock:
+                if self._conn is None:
+                    conn = sqlite3.connect(
+                        str(self.path),
+                        check_same_thread=False,
+                        cached_statements=DB_CACHED_STATEMENTS,
+                    )
+                    conn.execute("PRAGMA journal_mode=WAL;")
+                    conn.execute("PRAGMA synchronous=NORMAL;")
+                    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+                    self._conn = conn
+        return self._conn
+
+    def execute(self, sql: str, params: Iterable[Any] = ()) -> int:
+        """Выполняет изменяющий запрос и коммитит его. Возвращает rowcount."""
+        with self.lock:
+            conn = self.connection()
+            cur = conn.execute(sql, tuple(params))
+            conn.commit()
+            return cur.rowcount
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Iterable[Any]]) -> None:
+        """Выполняет один запрос для многих наборов параметров в одной транзакции."""
+        with self.lock:
+            conn = self.connection()
+            conn.executemany(sql, seq_of_params)
+            conn.commit()
+
+    def fetchone(self, sql: str, params: Iterable[Any] = ()) -> Optional[tuple]:
+        with self.lock:
+            return self.connection().execute(sql, tuple(params)).fetchone()
+
+    def fetchall(self, sql: str, params: Iterable[Any] = ()) -> list:
+        with self.lock:
+            return self.connection().execute(sql, tuple(params)).fetchall()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Несколько запросов одной транзакцией: commit при успехе, rollback при исключении."""
+        with self.lock:
+            conn = self.connection()
+            cur = conn.cursor()
+            try:
+                yield cur
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database.
+    Все запросы выполняет один поток-писатель: он забирает из очереди всё, что успело
+    накопиться (до DB_BATCH_MAX), и выполняет одной транзакцией. Каждый запрос идёт
+    в своём SAVEPOINT, так что ошибка одного не откатывает соседей по пачке.
+    """
+
+    _STOP = object()
+
+    def __init__(self, database: Database):
+        self.database = database
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="db-writer", daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def _resolve(fut: asyncio.Future, result: Any, error: Optional[BaseException]) -> None:
+        if fut.cancelled():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is self._STOP:
+                return
+            batch = [job]
+            stop = False
+            while len(batch) < DB_BATCH_MAX:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is self._STOP:
+                    stop = True
+                    break
+                batch.append(job)
+
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _run_batch(self, batch: list) -> None:
+        results = []
+        with self.database.lock:
+            conn = self.database.connection()
+            try:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN;")
+                for fn, loop, fut in batch:
+                    cur = conn.cursor()
+                    cur.execute("SAVEPOINT job;")
+                    try:
+                        value = fn(cur)
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO job;")
+                        cur.execute("RELEASE job;")
+                        results.append((loop, fut, None, e))
+                    else:
+                        cur.execute("RELEASE job;")
+                        results.append((loop, fut, value, None))
+                conn.commit()
+            except Exception as e:
+                # упал сам commit/BEGIN — вся пачка не записана
+                logging.error(f"Ошибка транзакции БД: {e}")
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                results = [(loop, fut, None, e) for _, loop, fut in batch]
+
+        for loop, fut, value, error in results:
+            try:
+                loop.call_soon_threadsafe(self._resolve, fut, value, error)
+            except RuntimeError:
+                pass  # event loop уже закрыт
+
+    def run(self, fn: Callable[[sqlite3.Cursor], Any]) -> "asyncio.Future":
+        """Выполнить fn(cursor) в потоке БД внутри транзакции. Возвращает awaitable с результатом fn."""
+        self._ensure_thread()
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((fn, loop, fut))
+        return fut
+
+    async def execute(self, sql: str, params: Iterable[Any] = ()) -> int:
+        params = tuple(params)
+        return await self.run(lambda cur: cur.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Iterable[Any]]) -> None:
+        rows = [tuple(p) for p in seq_of_params]
+        await self.run(lambda cur: cur.executemany(sql, rows))
+
+    async def fetchone(self, sql: str, params: Iterable[Any] = ()) -> Optional[tuple]:
+        params = tuple(params)
+        return await self.run(lambda cur: cur.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Iterable[Any] = ()) -> list:
+        params = tuple(params)
+        return await self.run(lambda cur: cur.execute(sql, params).fetchall())
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Дождаться выполнения очереди и остановить поток (вызывать перед выходом)."""
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+
+# Общий объект базы для всего процесса
+db = Database(DB_PATH)
+
+# Асинхронный доступ к той же базе — для кода внутри event loop
+adb = AsyncDatabase(db)
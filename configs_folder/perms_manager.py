@@ -13,16 +13,46 @@
 - LEAVE - право отключиться от голосового канала
 
 Доступ к независимым ролям можно получить от HOST или OWNER.
+
+Права держатся в памяти процесса (_PermsCache): файл читается один раз и
+перечитывается только если у него изменились mtime/размер (например, его
+поправили руками) или после изменения через функции этого модуля.
+Изменения пишутся на диск отложенно и атомарно, перед выходом нужен flush_perms().
+
+Вместо JSON права можно хранить в SQLite (bot_state.db): "PERMS_BACKEND": "sqlite"
+в setings.json (запись через поток-писатель adb из db_manager). При первом запуске права переносятся из perms_data.json.
 """
 
+import asyncio
+import atexit
 import json
+import logging
+import os
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Set, List, Dict, Optional
+from typing import Set, List, Dict, Optional, Iterable, TYPE_CHECKING
 from enum import Enum
 
+if TYPE_CHECKING:
+    from configs_folder.db_manager import AsyncDatabase, Database
+
 # Путь к файлу с правами
 PERMS_FILE = Path(__file__).parent / "perms_data.json"
 
+# Настройки бота (оттуда берётся PERMS_BACKEND: "json" или "sqlite")
+SETINGS_FILE = Path(__file__).parent / "setings.json"
+
+# Последняя удачная версия файла прав (на случай повреждения основного)
+PERMS_BACKUP_FILE = PERMS_FILE.with_name(PERMS_FILE.name + ".bak")
+
+# Как часто (в секундах) проверять, не изменился ли файл на диске
+PERMS_STAT_INTERVAL = 1.0
+
+# Через сколько секунд после изменения записывать права на диск (изменения за это время склеиваются)
+PERMS_FLUSH_DELAY = 1.0
+
 
 class PermRole(Enum):
     """Роли прав."""
@@ -58,37 +88,380 @@ ALL_ROLES = set(PermRole)
 # Роли, которые нельзя менять ни при каких условиях
 PROTECTED_ROLES = {PermRole.HOST, PermRole.OWNER, PermRole.PERMSMANAGER}
 
+# Роль по строковому значению (для разбора JSON)
+_ROLE_BY_VALUE = {r.value: r for r in PermRole}
+
+# Индекс иерархической роли (0 = HOST)
+_HIERARCHY_INDEX = {r: i for i, r in enumerate(HIERARCHY_ROLES)}
+
+# Бит каждой роли в маске прав
+ROLE_BITS = {r: 1 << i for i, r in enumerate(PermRole)}
+
 
-def _load_perms() -> Dict[int, Set[PermRole]]:
-    """Загружает права из JSON файла."""
-    if not PERMS_FILE.exists():
-        return {}
+def _implied_mask(role: PermRole) -> int:
+    """
+    Маска эффективных прав, которые даёт одна роль:
+    иерархическая роль даёт себя и все роли ниже, HOST/OWNER дополнительно дают все независимые.
+    """
+    if role not in _HIERARCHY_INDEX:
+        return ROLE_BITS[role]
+
+    mask = 0
+    for lower in HIERARCHY_ROLES[_HIERARCHY_INDEX[role]:]:
+        mask |= ROLE_BITS[lower]
+    if role in (PermRole.HOST, PermRole.OWNER):
+        for independent in INDEPENDENT_ROLES:
+            mask |= ROLE_BITS[independent]
+    return mask
+
+
+_IMPLIED_MASKS = {r: _implied_mask(r) for r in PermRole}
+
+
+def compile_mask(roles: Iterable[PermRole]) -> int:
+    """Сворачивает набор ролей в маску эффективных прав."""
+    mask = 0
+    for role in roles:
+        mask |= _IMPLIED_MASKS[role]
+    return mask
+
+
+def _read_perms_file(path: Path) -> Dict[int, Set[PermRole]]:
+    """Читает и разбирает один файл прав."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
     
-    try:
-        with open(PERMS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        # Конвертируем строки обратно в enum
-        result = {}
-        for user_id_str, roles in data.items():
-            user_id = int(user_id_str)
-            result[user_id] = {PermRole(role) for role in roles if role in [r.value for r in PermRole]}
-        
-        return result
-    except (json.JSONDecodeError, IOError, ValueError):
-        return {}
+    # Конвертируем строки обратно в enum
+    result = {}
+    for user_id_str, roles in data.items():
+        user_id = int(user_id_str)
+        result[user_id] = {_ROLE_BY_VALUE[role] for role in roles if role in _ROLE_BY_VALUE}
+    
+    return result
 
 
-def _save_perms(perms: Dict[int, Set[PermRole]]) -> None:
-    """Сохраняет права в JSON файл."""
-    data = {
+def _load_perms() -> tuple[Dict[int, Set[PermRole]], bool]:
+    """
+    Загружает права из JSON файла.
+    Если файл повреждён (или пропал посреди записи), берёт последнюю удачную копию PERMS_BACKUP_FILE.
+    Возвращает (права, прочитан_ли_основной_файл).
+    """
+    for path in (PERMS_FILE, PERMS_BACKUP_FILE):
+        if not path.exists():
+            continue
+        try:
+            return _read_perms_file(path), path == PERMS_FILE
+        except (json.JSONDecodeError, IOError, ValueError, AttributeError) as e:
+            logging.error(f"Не удалось прочитать {path.name}: {e}")
+    return {}, False
+
+
+def _dump_perms(perms: Dict[int, Set[PermRole]]) -> Dict[str, List[str]]:
+    """Готовит права к записи в JSON."""
+    return {
         str(user_id): sorted([role.value for role in roles])
         for user_id, roles in perms.items()
         if roles  # Не сохраняем пустые записи
     }
-    
-    with open(PERMS_FILE, "w", encoding="utf-8") as f:
+
+
+def _save_perms(data: Dict[str, List[str]], keep_backup: bool = True) -> None:
+    """
+    Атомарно сохраняет права в JSON файл: временный файл + fsync + rename.
+    Если keep_backup, текущая (заведомо целая) версия файла перед заменой становится PERMS_BACKUP_FILE.
+    """
+    tmp_path = PERMS_FILE.with_name(PERMS_FILE.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if keep_backup and PERMS_FILE.exists():
+        os.replace(PERMS_FILE, PERMS_BACKUP_FILE)
+    os.replace(tmp_path, PERMS_FILE)
+
+    # fsync каталога, чтобы rename пережил падение питания (на Windows не поддерживается)
+    try:
+        dir_fd = os.open(PERMS_FILE.parent, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class _PermsCache:
+    """
+    Кэш прав в памяти процесса.
+    Файл перечитывается только при изменении его (mtime, size), а проверка
+    os.stat делается не чаще раза в PERMS_STAT_INTERVAL секунд.
+    Вместе с ролями хранятся маски эффективных прав (compile_mask) для has_perm.
+
+    Изменения пишутся на диск отложенно (write-behind): save() только помечает кэш
+    грязным, а запись делает фоновый таймер через PERMS_FLUSH_DELAY секунд, так что
+    серия изменений подряд превращается в одну запись. flush() пишет немедленно.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._perms: Optional[Dict[int, Set[PermRole]]] = None
+        self._masks: Dict[int, int] = {}
+        self._signature: Optional[tuple[int, int]] = None
+        self._checked_at = 0.0
+        self._dirty = False
+        self._file_ok = False  # основной файл целый и его можно сделать резервной копией
+        self._timer: Optional[threading.Timer] = None
+
+    def _file_signature(self) -> Optional[tuple[int, int]]:
+        try:
+            st = self.path.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self) -> Dict[int, Set[PermRole]]:
+        """Возвращает актуальный словарь прав (живой объект кэша, не менять снаружи)."""
+        now = time.monotonic()
+        if self._perms is not None and (self._dirty or now - self._checked_at < PERMS_STAT_INTERVAL):
+            return self._perms
+
+        with self.lock:
+            self._checked_at = now
+            signature = self._file_signature()
+            if self._perms is None or signature != self._signature:
+                # подпись берём до чтения: если файл поменяется во время чтения, перечитаем в следующий раз
+                self._perms, self._file_ok = _load_perms()
+                self._masks = {user_id: compile_mask(roles) for user_id, roles in self._perms.items()}
+                self._signature = signature
+            return self._perms
+
+    def masks(self) -> Dict[int, int]:
+        """Возвращает актуальные маски эффективных прав пользователей."""
+        self.get()
+        return self._masks
+
+    def save(self, perms: Dict[int, Set[PermRole]], user_id: Optional[int] = None) -> None:
+        """
+        Принимает изменённые права и планирует их запись на диск.
+        Если передан user_id, пересчитывается маска только этого пользователя.
+        """
+        with self.lock:
+            if user_id is not None and perms is self._perms:
+                if perms.get(user_id):
+                    self._masks[user_id] = compile_mask(perms[user_id])
+                else:
+                    self._masks.pop(user_id, None)
+            else:
+                self._masks = {uid: compile_mask(roles) for uid, roles in perms.items()}
+            self._perms = perms
+            self._dirty = True
+
+            # таймер уже взведён — изменение уйдёт вместе с остальными
+            if self._timer is None:
+                self._timer = threading.Timer(PERMS_FLUSH_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """Немедленно записывает накопленные изменения на диск."""
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty or self._perms is None:
+                return
+            try:
+                _save_perms(_dump_perms(self._perms), keep_backup=self._file_ok)
+            except Exception as e:
+                # изменения остаются в памяти и грязными — попробуем снова при следующем flush
+                logging.error(f"Не удалось сохранить {self.path.name}: {e}")
+                return
+            self._dirty = False
+            self._file_ok = True
+            self._signature = self._file_signature()
+            self._checked_at = time.monotonic()
+
+    def users_with_role(self, role: PermRole) -> List[int]:
+        return [user_id for user_id, roles in self.get().items() if role in roles]
+
+    def invalidate(self) -> None:
+        """Сбрасывает кэш, следующее обращение перечитает файл (несохранённые изменения сначала пишутся)."""
+        with self.lock:
+            self.flush()
+            self._perms = None
+            self._signature = None
+
+
+class _SqlitePerms:
+    """
+    Хранилище прав в SQLite (таблица perms).
+    Маски для has_perm так же держатся в памяти, а изменения пишутся точечно (строки одного
+    пользователя) через поток-писатель adb, поэтому event loop не ждёт ни commit, ни общий db.lock.
+    Изменения из другого процесса замечаются по PRAGMA data_version на отдельном читающем
+    соединении: в WAL читатель не ждёт писателя.
+    """
+
+    def __init__(self, database: "Database", async_database: "AsyncDatabase"):
+        self.path = database.path
+        self.database = database
+        self.adb = async_database
+        self.lock = threading.RLock()  # только состояние в памяти, не база
+        self._perms: Optional[Dict[int, Set[PermRole]]] = None
+        self._masks: Dict[int, int] = {}
+        self._data_version: Optional[int] = None
+        self._checked_at = 0.0
+        self._pending_writes = 0  # записи в очереди adb: пока они не дошли, база отстаёт от памяти
+        self._init_table()
+        self._reader = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._reader.execute("PRAGMA query_only = ON;")
+
+    def _init_table(self) -> None:
+        with self.database.transaction() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS perms (
+                    user_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    PRIMARY KEY (user_id, role)
+                ) WITHOUT ROWID;
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_perms_role ON perms (role, user_id);")
+            # первый запуск на SQLite — переносим права из perms_data.json
+            cur.execute("SELECT 1 FROM perms LIMIT 1;")
+            empty = cur.fetchone() is None
+        if empty and (PERMS_FILE.exists() or PERMS_BACKUP_FILE.exists()):
+            imported = self.import_json()
+            logging.info(f"Импортировано прав из {PERMS_FILE.name} в SQLite: {imported}")
+
+    def import_json(self) -> int:
+        """Одноразово переносит права из perms_data.json в таблицу. Возвращает число записанных пар (user, role)."""
+        perms, _ = _load_perms()
+        rows = [(user_id, role.value) for user_id, roles in perms.items() for role in roles]
+        self.database.executemany("INSERT OR IGNORE INTO perms (user_id, role) VALUES (?, ?);", rows)
+        with self.lock:
+            self._perms = None
+        return len(rows)
+
+    def get(self) -> Dict[int, Set[PermRole]]:
+        """Возвращает актуальный словарь прав (живой объект, не менять снаружи)."""
+        now = time.monotonic()
+        if self._perms is not None and (self._pending_writes or now - self._checked_at < PERMS_STAT_INTERVAL):
+            return self._perms
+
+        with self.lock:
+            self._checked_at = now
+            data_version = self._reader.execute("PRAGMA data_version;").fetchone()[0]
+            if self._perms is None or data_version != self._data_version:
+                perms: Dict[int, Set[PermRole]] = {}
+                for user_id, role in self._reader.execute("SELECT user_id, role FROM perms;"):
+                    if role in _ROLE_BY_VALUE:
+                        perms.setdefault(int(user_id), set()).add(_ROLE_BY_VALUE[role])
+                self._perms = perms
+                self._masks = {uid: compile_mask(roles) for uid, roles in perms.items()}
+                self._data_version = data_version
+            return self._perms
+
+    def masks(self) -> Dict[int, int]:
+        """Возвращает актуальные маски эффективных прав пользователей."""
+        self.get()
+        return self._masks
+
+    def save(self, perms: Dict[int, Set[PermRole]], user_id: Optional[int] = None) -> None:
+        """Обновляет маски и ставит запись ролей user_id (или всех прав) в очередь adb."""
+        with self.lock:
+            replace_all = user_id is None
+            user_ids = list(perms) if replace_all else [user_id]
+            if replace_all:
+                self._masks = {}
+            rows = []
+            for uid in user_ids:
+                rows.extend((uid, role.value) for role in perms.get(uid, ()))
+                if perms.get(uid):
+                    self._masks[uid] = compile_mask(perms[uid])
+                else:
+                    self._masks.pop(uid, None)
+            self._perms = perms
+
+        def write(cur) -> None:
+            if replace_all:
+                cur.execute("DELETE FROM perms;")
+            else:
+                cur.execute("DELETE FROM perms WHERE user_id = ?;", (user_id,))
+            cur.executemany("INSERT INTO perms (user_id, role) VALUES (?, ?);", rows)
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # вне event loop (скрипты, тесты) — пишем сразу
+            with self.database.transaction() as cur:
+                write(cur)
+            return
+
+        with self.lock:
+            self._pending_writes += 1
+        self.adb.run(write).add_done_callback(self._on_written)
+
+    def _on_written(self, fut: "asyncio.Future") -> None:
+        with self.lock:
+            self._pending_writes -= 1
+            if not fut.cancelled() and fut.exception() is not None:
+                logging.error(f"Не удалось сохранить права в SQLite: {fut.exception()}")
+                self._perms = None  # в памяти то, чего нет в базе — перечитаем
+
+    def users_with_role(self, role: PermRole) -> List[int]:
+        return [user_id for user_id, roles in self.get().items() if role in roles]
+
+    def flush(self) -> None:
+        """Записи уходят через adb; перед выходом их дописывает adb.close()."""
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self._perms = None
+
+
+def _read_backend_name() -> str:
+    """Читает PERMS_BACKEND из setings.json ("json" по умолчанию)."""
+    try:
+        with open(SETINGS_FILE, "r", encoding="utf-8") as f:
+            return str(json.load(f).get("PERMS_BACKEND", "json")).lower()
+    except (OSError, json.JSONDecodeError, AttributeError):
+        return "json"
+
+
+PERMS_BACKEND = _read_backend_name()
+
+if PERMS_BACKEND == "sqlite":
+    from configs_folder.db_manager import db, adb
+    _store = _SqlitePerms(db, adb)
+else:
+    if PERMS_BACKEND != "json":
+        logging.warning(f"Неизвестный PERMS_BACKEND={PERMS_BACKEND!r}, используется json")
+        PERMS_BACKEND = "json"
+    _store = _PermsCache(PERMS_FILE)
+
+
+def reload_perms() -> None:
+    """Принудительно перечитать perms_data.json при следующей проверке прав."""
+    _store.invalidate()
+
+
+def import_perms_from_json() -> int:
+    """Переносит права из perms_data.json в SQLite (только для PERMS_BACKEND = "sqlite")."""
+    if not isinstance(_store, _SqlitePerms):
+        raise RuntimeError("Импорт доступен только при PERMS_BACKEND = \"sqlite\"")
+    return _store.import_json()
+
+
+def flush_perms() -> None:
+    """Сразу записать отложенные изменения прав. Вызывать перед рестартом/выключением."""
+    _store.flush()
+
+
+# на случай обычного завершения интерпретатора (os._exit сюда не попадает — там flush_perms вызывается явно)
+atexit.register(flush_perms)
 
 
 def _get_hierarchy_level(roles: Set[PermRole]) -> int:
@@ -97,11 +470,7 @@ def _get_hierarchy_level(roles: Set[PermRole]) -> int:
     0 = HOST (высший), 1 = OWNER, 2 = PERMSMANAGER
     Возвращает 999 если нет иерархических ролей.
     """
-    hierarchy_roles_user = [r for r in roles if r in HIERARCHY_ROLES]
-    if not hierarchy_roles_user:
-        return 999
-    
-    return min(HIERARCHY_ROLES.index(r) for r in hierarchy_roles_user)
+    return min((_HIERARCHY_INDEX[r] for r in roles if r in _HIERARCHY_INDEX), default=999)
 
 
 def has_perm(user_id: int, required_role: PermRole) -> bool:
@@ -111,41 +480,22 @@ def has_perm(user_id: int, required_role: PermRole) -> bool:
     Логика:
     - Если требуемая роль иерархическая: проверяем, есть ли роль на том же уровне или выше
     - Если требуемая роль независимая: проверяем наличие роли ИЛИ роли HOST/OWNER
+
+    Оба правила уже учтены в маске пользователя (compile_mask), так что проверка — одно AND.
     """
-    perms = _load_perms()
-    user_roles = perms.get(user_id, set())
-    
-    if not user_roles:
-        return False
-    
-    # Если требуемая роль иерархическая
-    if required_role in HIERARCHY_ROLES:
-        required_idx = HIERARCHY_ROLES.index(required_role)
-        # Проверяем, есть ли у пользователя роль с равным или более высоким уровнем
-        for role in user_roles:
-            if role in HIERARCHY_ROLES:
-                role_idx = HIERARCHY_ROLES.index(role)
-                if role_idx <= required_idx:
-                    return True
-        return False
-    
-    # Если требуемая роль независимая
-    if required_role in INDEPENDENT_ROLES:
-        # У пользователя есть сама роль
-        if required_role in user_roles:
-            return True
-        # ИЛИ у пользователя есть HOST или OWNER
-        if PermRole.HOST in user_roles or PermRole.OWNER in user_roles:
-            return True
-        return False
-    
-    return False
+    return bool(_store.masks().get(user_id, 0) & ROLE_BITS[required_role])
+
+
+def has_perm_many(user_ids: Iterable[int], required_role: PermRole) -> Dict[int, bool]:
+    """Проверяет одно право сразу для многих пользователей (массовые операции, аудит)."""
+    masks = _store.masks()
+    bit = ROLE_BITS[required_role]
+    return {user_id: bool(masks.get(user_id, 0) & bit) for user_id in user_ids}
 
 
 def get_user_roles(user_id: int) -> Set[PermRole]:
-    """Возвращает все роли пользователя."""
-    perms = _load_perms()
-    return perms.get(user_id, set())
+    """Возвращает все роли пользователя (копию, кэш менять нельзя)."""
+    return set(_store.get().get(user_id, ()))
 
 
 def add_perm(user_id: int, role: PermRole) -> bool:
@@ -153,15 +503,13 @@ def add_perm(user_id: int, role: PermRole) -> bool:
     Добавляет роль пользователю.
     Возвращает True если успешно, False если уже есть.
     """
-    perms = _load_perms()
-    if user_id not in perms:
-        perms[user_id] = set()
-    
-    if role in perms[user_id]:
-        return False
-    
-    perms[user_id].add(role)
-    _save_perms(perms)
+    with _store.lock:
+        perms = _store.get()
+        if role in perms.get(user_id, ()):
+            return False
+        
+        perms.setdefault(user_id, set()).add(role)
+        _store.save(perms, user_id)
     return True
 
 
@@ -173,39 +521,34 @@ def remove_perm(user_id: int, role: PermRole) -> bool:
     if role in PROTECTED_ROLES:
         return False
     
-    perms = _load_perms()
-    if user_id not in perms or role not in perms[user_id]:
-        return False
-    
-    perms[user_id].remove(role)
-    if not perms[user_id]:
-        del perms[user_id]
-    
-    _save_perms(perms)
+    with _store.lock:
+        perms = _store.get()
+        if user_id not in perms or role not in perms[user_id]:
+            return False
+        
+        perms[user_id].remove(role)
+        if not perms[user_id]:
+            del perms[user_id]
+        
+        _store.save(perms, user_id)
     return True
 
 
 def set_user_perms(user_id: int, roles: Set[PermRole]) -> None:
     """Устанавливает все роли для пользователя."""
-    perms = _load_perms()
-    if roles:
-        perms[user_id] = roles
-    elif user_id in perms:
-        del perms[user_id]
-    
-    _save_perms(perms)
+    with _store.lock:
+        perms = _store.get()
+        if roles:
+            perms[user_id] = set(roles)
+        elif user_id in perms:
+            del perms[user_id]
+        
+        _store.save(perms, user_id)
 
 
 def get_all_users_with_role(role: PermRole) -> List[int]:
     """Возвращает список ID всех пользователей с данной ролью."""
-    perms = _load_perms()
-    result = []
-    
-    for user_id, roles in perms.items():
-        if role in roles:
-            result.append(user_id)
-    
-    return result
+    return _store.users_with_role(role)
 
 
 def get_hierarchy_level(user_id: int) -> int:
@@ -214,8 +557,7 @@ def get_hierarchy_level(user_id: int) -> int:
     0 = HOST (высший), 1 = OWNER, 2 = PERMSMANAGER.
     Если нет иерархических ролей, возвращает 999.
     """
-    roles = get_user_roles(user_id)
-    return _get_hierarchy_level(roles)
+    return _get_hierarchy_level(_store.get().get(user_id, set()))
 
 
 def can_manage_role(manager_id: int, target_id: int, role: PermRole) -> tuple[bool, str]:
@@ -271,9 +613,8 @@ def get_role_description(role: PermRole) -> str:
 # Инициализация: убедимся что OWNER есть
 def init_perms(owner_id: int) -> None:
     """Инициализирует систему, добавляя owner если его нет."""
-    perms = _load_perms()
-    if owner_id not in perms or PermRole.OWNER not in perms.get(owner_id, set()):
-        if owner_id not in perms:
-            perms[owner_id] = set()
-        perms[owner_id].add(PermRole.OWNER)
-        _save_perms(perms)
+    with _store.lock:
+        perms = _store.get()
+        if PermRole.OWNER not in perms.get(owner_id, ()):
+            perms.setdefault(owner_id, set()).add(PermRole.OWNER)
+            _store.save(perms, owner_id)
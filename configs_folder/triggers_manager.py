@@ -0,0 +1,187 @@
+"""
+Авто-ответы бота на сообщения (триггеры).
+
+Правила лежат в configs_folder/triggers.json (при первом запуске создаётся из DEFAULT_TRIGGERS)
+и перечитываются на лету: файл проверяется не чаще раза в TRIGGERS_STAT_INTERVAL секунд,
+при изменении (mtime, size) правила компилируются заново. Если новый файл с ошибкой —
+в лог пишется ошибка и продолжают работать прежние правила.
+
+Правило:
+    {
+        "name": "everyone",             # для логов и ошибок
+        "match": "substring",           # exact | substring | regex
+        "pattern": "@everyone",         # сравнивается с сообщением в нижнем регистре
+        "reply": "https://tenor.com/...",
+        "probability": 1.0,             # шанс ответить при совпадении (0..1)
+        "delete_after": 15              # через сколько секунд удалить ответ, null — не удалять
+    }
+
+Все правила компилируются в один матчер: exact — словарь по тексту сообщения,
+substring и regex — одно регулярное выражение-альтернация. Сообщение приводится к нижнему
+регистру один раз и просматривается этим выражением один раз; подавляющее большинство
+сообщений ни с чем не совпадает, и на этом проверка заканчивается. Только при совпадении
+каждое правило из альтернации проверяется отдельно (альтернация находит одно правило
+на позицию, а совпасть могут сразу несколько).
+"""
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+TRIGGERS_FILE = Path(__file__).parent / "triggers.json"
+
+# Как часто (сек) проверять, не изменился ли файл правил
+TRIGGERS_STAT_INTERVAL = 1.0
+
+_GHOST_PING = "||||\u200b" * 120  # длинный спойлер-"призрак", которым прячут пинг
+
+DEFAULT_TRIGGERS = [
+    {"name": "bot_ping", "match": "substring", "pattern": "<@1409084528588488727>",
+     "reply": "https://tenor.com/view/fuck-you-gif-27037587", "delete_after": 10},
+    {"name": "osuzhdayu", "match": "substring", "pattern": "осуждаю",
+     "reply": "https://tenor.com/view/%D1%81%D1%82%D0%B8%D0%BD%D1%82-%D1%81%D1%82%D0%B8%D0%BD%D1%82%D0%B8%D0%BA-stint-stintik-%D0%B8%D1%81%D0%BF%D1%83%D0%B3%D0%B0%D0%BB%D1%81%D1%8F-gif-8740975965519379714",
+     "delete_after": 15},
+    {"name": "ghost_ping", "match": "substring", "pattern": _GHOST_PING,
+     "reply": "https://tenor.com/view/ghost-ping-troll-discord-gif-20744771"},
+    {"name": "everyone", "match": "substring", "pattern": "@everyone",
+     "reply": "https://tenor.com/view/everyone-discord-konosuba-gif-21395141", "delete_after": 15},
+    {"name": "here", "match": "substring", "pattern": "@here",
+     "reply": "https://tenor.com/view/everyone-discord-gif-18237159", "delete_after": 15},
+    {"name": "da", "match": "exact", "pattern": "да",
+     "reply": "пизда", "probability": 0.02, "delete_after": 60},
+    {"name": "net", "match": "exact", "pattern": "нет",
+     "reply": "пидора ответ", "probability": 0.02, "delete_after": 60},
+]
+
+_MATCH_KINDS = ("exact", "substring", "regex")
+
+
+class TriggerRule:
+    __slots__ = ("index", "name", "match", "pattern", "reply", "probability", "delete_after", "regex")
+
+    def __init__(self, index: int, data: dict):
+        self.index = index
+        self.name = str(data.get("name") or f"#{index}")
+        self.match = data.get("match", "substring")
+        if self.match not in _MATCH_KINDS:
+            raise ValueError(f"правило {self.name}: match должен быть одним из {', '.join(_MATCH_KINDS)}")
+
+        pattern, reply = data.get("pattern"), data.get("reply")
+        if not isinstance(pattern, str) or not pattern:
+            raise ValueError(f"правило {self.name}: пустой pattern")
+        if not isinstance(reply, str) or not reply:
+            raise ValueError(f"правило {self.name}: пустой reply")
+        self.pattern = pattern if self.match == "regex" else pattern.lower()
+        self.reply = reply
+
+        self.probability = float(data.get("probability", 1.0))
+        if not 0.0 <= self.probability <= 1.0:
+            raise ValueError(f"правило {self.name}: probability должна быть от 0 до 1")
+        delete_after = data.get("delete_after")
+        self.delete_after = float(delete_after) if delete_after is not None else None
+
+        if self.match == "regex":
+            try:
+                self.regex = re.compile(self.pattern)
+            except re.error as e:
+                raise ValueError(f"правило {self.name}: неверный regex: {e}")
+        else:
+            self.regex = re.compile(re.escape(self.pattern)) if self.match == "substring" else None
+
+    def fires(self) -> bool:
+        return self.probability >= 1.0 or random.random() < self.probability
+
+
+class CompiledTriggers:
+    """Набор правил, собранный в один матчер (см. описание модуля)."""
+
+    def __init__(self, rules: List[TriggerRule]):
+        self.rules = rules
+        self.exact: Dict[str, List[TriggerRule]] = {}
+        self.scan_rules = [rule for rule in rules if rule.match != "exact"]
+        for rule in rules:
+            if rule.match == "exact":
+                self.exact.setdefault(rule.pattern, []).append(rule)
+        self.scan: Optional[re.Pattern] = None
+        if self.scan_rules:
+            try:
+                self.scan = re.compile("|".join(f"(?:{rule.regex.pattern})" for rule in self.scan_rules))
+            except re.error as e:
+                raise ValueError(f"regex правила нельзя объединить в одно выражение: {e}")
+
+    def match(self, text: str) -> List[TriggerRule]:
+        """Правила, совпавшие с текстом (уже в нижнем регистре), в порядке файла."""
+        hits = list(self.exact.get(text, ()))
+        if self.scan is not None and self.scan.search(text) is not None:
+            hits.extend(rule for rule in self.scan_rules if rule.regex.search(text) is not None)
+            hits.sort(key=lambda rule: rule.index)
+        return hits
+
+
+def compile_triggers(data: list) -> CompiledTriggers:
+    if not isinstance(data, list):
+        raise ValueError("ожидается список правил")
+    return CompiledTriggers([TriggerRule(i, item) for i, item in enumerate(data)])
+
+
+class TriggerEngine:
+    """Правила триггеров в памяти с перечитыванием файла при изменении."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._compiled: Optional[CompiledTriggers] = None
+        self._signature: Optional[tuple[int, int]] = None
+        self._checked_at = 0.0
+
+    def _file_signature(self) -> Optional[tuple[int, int]]:
+        try:
+            st = self.path.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self) -> CompiledTriggers:
+        if not self.path.exists():
+            self.path.write_text(json.dumps(DEFAULT_TRIGGERS, ensure_ascii=False, indent=4), encoding="utf-8")
+        with self.path.open("r", encoding="utf-8") as f:
+            return compile_triggers(json.load(f))
+
+    def get(self) -> CompiledTriggers:
+        now = time.monotonic()
+        if self._compiled is not None and now - self._checked_at < TRIGGERS_STAT_INTERVAL:
+            return self._compiled
+
+        with self.lock:
+            self._checked_at = now
+            signature = self._file_signature()
+            if self._compiled is None or signature != self._signature:
+                self._signature = signature
+                try:
+                    self._compiled = self._load()
+                    self._signature = self._file_signature()
+                except Exception as e:
+                    logging.error(f"Не удалось загрузить {self.path.name}, работают прежние правила: {e}")
+                    if self._compiled is None:
+                        self._compiled = compile_triggers(DEFAULT_TRIGGERS)
+            return self._compiled
+
+    def reload(self) -> int:
+        """Перечитать файл немедленно. Ошибку в файле пробрасывает (прежние правила остаются)."""
+        with self.lock:
+            compiled = self._load()
+            self._compiled = compiled
+            self._signature = self._file_signature()
+            self._checked_at = time.monotonic()
+            return len(compiled.rules)
+
+    def match(self, content: str) -> List[TriggerRule]:
+        return self.get().match(content.lower())
+
+
+triggers = TriggerEngine(TRIGGERS_FILE)
@@ -0,0 +1,59 @@
+"""Регрессии оценки стоимости калькулятора: тяжёлое не должно считаться в event loop бота."""
+
+import pytest
+
+from configs_folder.calculator import CALC_INLINE_MAX_BITS, CalcError, calc_prepare, compile_expression
+
+
+@pytest.mark.parametrize("expr", [
+    "b'a'*10**8",
+    "'%0100000000d' % 1",
+    "b'%0100000000d' % 1",
+    "'%.100000000f' % 1",
+    "('%0' + '100000000d') % 1",
+])
+def test_huge_strings_are_rejected(expr):
+    with pytest.raises(CalcError):
+        compile_expression(expr)
+
+
+@pytest.mark.parametrize("expr, expected", [
+    ("'%d' % 5", "5"),
+    ("'%5.2f' % 3.14159", " 3.14"),
+])
+def test_small_formatting_is_inline(expr, expected):
+    fn, cost = compile_expression(expr)
+    assert cost <= CALC_INLINE_MAX_BITS
+    assert fn() == expected
+
+
+def test_factorial_1000_is_inline():
+    assert not calc_prepare("factorial(1000)").heavy
+    assert calc_prepare("factorial(5000)").heavy
+
+
+@pytest.mark.parametrize("expr", ["2**15000", "factorial(1600)"])
+def test_numbers_over_str_limit_are_heavy(expr):
+    assert calc_prepare(expr).heavy
+
+
+@pytest.mark.parametrize("expr", ["round(1, -10**6)", "round(1, -10**7)"])
+def test_round_with_huge_ndigits_is_not_inline(expr):
+    try:
+        assert calc_prepare(expr).heavy
+    except CalcError:
+        pass  # отклонено сразу — тоже не в event loop
+
+
+def test_round_with_small_ndigits_is_inline():
+    fn, cost = compile_expression("round(3.14159, 2)")
+    assert cost <= CALC_INLINE_MAX_BITS
+    assert fn() == 3.14
+
+
+def test_integer_range_without_numpy(monkeypatch):
+    import configs_folder.calculator as calculator
+    monkeypatch.setattr(calculator, "np", None)
+    result = calculator.calc_range("x & 3 for x in 0..100 step 1")
+    assert result.stats()["errors"] == 0
+    assert result.ys[:5] == [0, 1, 2, 3, 0]